@@ -7,23 +7,46 @@ The scanned book can be inserted/removed from the DB, by setting the field
 `in_lib` to 1/0, or moved to another location. Both `isbn_10` and `isbn_13` can
 be used.
 
-If the book is not found in the `DB` the ISBN is appended to the
-`unknown_barcodes.pickle` file.
+All isbns are indexed in memory at startup (`IsbnIndex`), so a scan is a dict
+lookup and doesn't query the DB.
+
+Unknown isbns are looked up online in the background (see `enrich.py`) and
+added to the DB with the scanned location, while the scanning goes on. `status`
+shows how many are pending, resolved or failed.
+
+If the book is not found in the `DB` the scan is appended to the `scan_event`
+table, with the location, and committed at once, so no scans are lost if the
+scanner crashes. An old `unknown_barcodes.pickle` is imported at startup.
 
 """
 
 
 import functools
 import logging
+import os
 import pickle
 import pprint
+import queue
 import select
+import sqlite3
 import sys
 import traceback
 
 from isbnlib import notisbn
 
-from bookdb import create_connection, get_locations_id, updatedb
+from bookdb import (
+    IsbnIndex,
+    add_scan_event,
+    compact_scan_events,
+    create_connection,
+    find_duplicates,
+    get_locations_id,
+    get_scanned_isbns,
+    import_scanned_isbns,
+    updatedb,
+    upgrade_schema,
+)
+from enrich import Enricher
 from helpers import get_serial_interface
 
 logging.basicConfig(level=logging.DEBUG)
@@ -91,14 +114,50 @@ def load_unknown_isbns():
     return old_data
 
 
-conn = create_connection(BOOKS_DB)
+def import_unknown_isbns(conn):
+    # move the isbns of the pickle file, used before scan_event, to the DB
+    if not os.path.exists(UNKNOWN_ISBN_FILE):
+        return
+    n = import_scanned_isbns(conn, load_unknown_isbns())
+    os.replace(UNKNOWN_ISBN_FILE, UNKNOWN_ISBN_FILE + ".imported")
+    print(f"imported {n} unknown isbns from {UNKNOWN_ISBN_FILE}")
+
+
+def save_scan(isbn, locid):
+    unknown_isbns[isbn] = locid
+    if SAVE_BARCODES:
+        add_scan_event(conn, isbn, locid)
+        # the enricher uses the location of the last scan
+        enricher.submit(isbn)
+
+
+def open_db():
+    # the scanner must start, even if the unique indexes cannot be created
+    conn = create_connection(BOOKS_DB)
+    try:
+        upgrade_schema(conn)
+    except sqlite3.IntegrityError:
+        # the unique indexes are the last migration, so the rest is done
+        print("duplicate books in the DB. Resolve these, to add the unique indexes")
+        for kind, value, ids in find_duplicates(conn):
+            print(f"  same {kind} {value}: books {ids}")
+    return conn
+
+
+conn = open_db()
 # {1: ('5', 'Biografi/Erindringer/Historie'), 2: ('6', 'Blandet indhold'), ...
 id_loc_map = get_locations_id(conn)
 loc_id_map = {v[0]: k for k, v in id_loc_map.items()}
+# isbn -> book, for all books. Updated together with the DB
+index = IsbnIndex(
+    conn, "id, title, authors, location, publisher, isbn, isbn_10, isbn_13, in_lib"
+)
 
 
 KEEP_SQL = "UPDATE book SET in_lib = ? WHERE id = ?;"
 MOVE_SQL = "UPDATE book SET location = ? WHERE id = ?;"
+# the column changed by the sql
+SQL_COLUMN = {KEEP_SQL: "in_lib", MOVE_SQL: "location"}
 
 # different inputs to read from. Nonblocking by using select
 try:
@@ -107,13 +166,35 @@ try:
 except KeyboardInterrupt:
     inputs = [sys.stdin]
 
-unknown_isbns = load_unknown_isbns()
+import_unknown_isbns(conn)
+compact_scan_events(conn)
+# isbn -> location of the last scan
+unknown_isbns = get_scanned_isbns(conn)
+
+# ids of the books added by the enricher, to be loaded into the index
+resolved = queue.Queue()
+enricher = Enricher(BOOKS_DB, on_resolved=lambda isbn, book_id: resolved.put(book_id))
+enricher.start()
+for isbn in unknown_isbns:
+    if not index.find(isbn):
+        enricher.submit(isbn)
+
+
+def load_resolved():
+    # add the books inserted by the enricher since the last scan to the index
+    book_ids = []
+    while not resolved.empty():
+        book_ids.append(resolved.get())
+    if book_ids:
+        index.load(conn, book_ids)
+
+
 loc = None
 ask_for_location = True
 isbn = None
 try:
     while True:
-        print("scan book. [loc], [batch], [c].")
+        print("scan book. [loc], [batch], [c], [status].")
         # read from multiple inputs
         (ready, [], []) = select.select(inputs, [], [])
         if not ready:
@@ -131,6 +212,11 @@ try:
         if barcode == "batch":
             ask_for_location = not ask_for_location
             continue
+        if barcode == "status":
+            print(f"online lookup of unknown isbns: {enricher.status()}")
+            for failed, message in enricher.failed().items():
+                print(f"  {failed}: {message}")
+            continue
         if barcode == "c":
             # get last scanned isbn - or last inserted isbn
             if not isbn:
@@ -138,7 +224,13 @@ try:
             locid = unknown_isbns[isbn]
             print(f"Previous book: {isbn}, {id_loc_map[locid]}")
             locid = query_new_location() or locid
-            unknown_isbns[isbn] = locid
+            save_scan(isbn, locid)
+            # the enricher might have added the book already
+            load_resolved()
+            book = index.find(isbn)
+            if book:
+                updatedb(conn, MOVE_SQL, (locid, book[0]))
+                index.update(book[0], SQL_COLUMN[MOVE_SQL], locid)
             print(f"{isbn} updated to {id_loc_map[locid]}")
             continue
 
@@ -147,22 +239,14 @@ try:
             continue
 
         isbn = barcode
-        data = {k: f"%{isbn}%" for k in ("isbn", "isbn_10", "isbn_13")}
-        sql = " like ? or ".join(data.keys()) + " like ?"
-        key = list(data.values())
-        sql = (
-            "SELECT id, title, authors, location, publisher, isbn, isbn_10, "
-            "isbn_13 FROM book WHERE "
-        ) + sql
-        cur = conn.cursor()
-        cur.execute(sql, key)
-        book = cur.fetchone()
+        load_resolved()
+        # lookup of isbn10/isbn13 in all the isbn columns
+        book = index.find(isbn)
 
         if book:
-            id, title, authors, location, publisher, isbn, isbn_10, isbn_13 = book
-            isbns = (isbn, isbn_10, isbn_13)
+            id, title, authors, location, publisher, *isbns, in_lib = book
             print(
-                f"{id}, {title} -- {authors}\n shelf: {id_loc_map[location]}, {publisher}, {isbns}"
+                f"{id}, {title} -- {authors}\n shelf: {id_loc_map[location]}, {publisher}, {tuple(isbns)}, in_lib: {in_lib}"
             )
             ret = (
                 input("Keep [Y/n]?, change loc [c], view loc [l] or dry-run [d]\n")
@@ -183,8 +267,8 @@ try:
                 sql = MOVE_SQL
             else:
                 continue
-            data = (data, id)
-            updatedb(conn, sql, data)
+            updatedb(conn, sql, (data, id))
+            index.update(id, SQL_COLUMN[sql], data)
 
         else:
             locid = None
@@ -195,7 +279,7 @@ try:
                 )
             if loc is None or ask_for_location or (locid is not None):
                 loc = query_new_location() or locid
-            unknown_isbns[isbn] = loc
+            save_scan(isbn, loc)
             print(
                 f"isbn {isbn} with loc {id_loc_map[loc]}."
                 f" [c] to change location"
@@ -205,11 +289,10 @@ except Exception as e:
 except KeyboardInterrupt:
     pass
 finally:
-    if SAVE_BARCODES:
-        # overwrite old data completely. Pickle streams are entirely
-        # self-contained, so if data was appended with '+ab' we would only load
-        # one pickle stream
-        with open(UNKNOWN_ISBN_FILE, "wb") as f:
-            pickle.dump(unknown_isbns, f)
-        print("unknown ISBNS saved")
-        pprint.pprint(unknown_isbns)
+    # every scan is already saved in scan_event. Pending lookups are done at
+    # the next start, don't wait for them
+    enricher.close(wait=False)
+    print(f"online lookup of unknown isbns: {enricher.status()}")
+    print("unknown ISBNS")
+    pprint.pprint(unknown_isbns)
+    conn.close()
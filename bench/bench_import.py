@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""Benchmark the mdb import without the network.
+
+The import in `mdb_read.py` is run against `fake_services.py`, started as a
+separate process, into a new empty sqlite DB. The rows are either read from an
+mdb file (needs mdbtools) or generated from the books in books.sqlite, scaled
+up to any number of rows.
+
+The result is printed as json, and can be saved with --output to track
+regressions:
+rows/sec, p50/p95/p99 latency per row (from read to written), requests per
+book and the peak RSS of the import process.
+
+Run from the root of the repo
+python bench/bench_import.py --scale 4 --latency 0.05 --workers 16
+python bench/bench_import.py --mdb bjerg2003.mdb
+python bench/bench_import.py --oldump
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import googleapi  # noqa: E402
+import helpers  # noqa: E402
+import mdb_read  # noqa: E402
+import oldump  # noqa: E402
+import openlapi  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from fake_services import catalogue, mdb_rows, ol_dump_lines  # noqa: E402
+
+LOGGER = logging.getLogger(__name__)
+
+BOOKS_DB = "books.sqlite"
+FAKE_SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_services.py")
+
+
+def start_services(args):
+    """Start fake_services.py and return (process, base url)"""
+    cmd = [
+        sys.executable,
+        FAKE_SERVICES,
+        "--db",
+        args.catalogue,
+        "--scale",
+        str(args.scale),
+        "--latency",
+        str(args.latency),
+        "--error-rate",
+        str(args.error_rate),
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline())
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def point_to(base):
+    """Send all openlapi/googleapi requests to base instead"""
+    for name in ("SERVICE_URL", "BATCH_URL", "SEARCH_URL", "EDITIONS_URL"):
+        url = getattr(openlapi, name)
+        setattr(openlapi, name, url.replace("http://openlibrary.org", base))
+    googleapi.SERVICE_URL = googleapi.SERVICE_URL.replace(
+        "https://www.googleapis.com", base
+    )
+
+
+def empty_db(books_db, filename):
+    """Create filename with the schema and locations of books_db, but no books"""
+    src = sqlite3.connect(f"file:{books_db}?mode=ro", uri=True)
+    dst = sqlite3.connect(filename)
+    # a copy keeps the tables, indexes, triggers and the search index in order
+    src.backup(dst)
+    src.close()
+    # the triggers empty the search index. The other tables of the books are
+    # kept in sync by bookdb, so they are emptied here
+    names = [name for (name,) in dst.execute("SELECT name FROM sqlite_master")]
+    tables = [
+        name
+        for (name,) in dst.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT IN ('book', 'location') AND name NOT LIKE 'sqlite_%' "
+            "AND name NOT LIKE 'book_fts%'"
+        )
+    ]
+    with dst:
+        dst.execute("DELETE FROM book")
+        for table in tables:
+            dst.execute(f"DELETE FROM {table}")
+        if "book_fts" in names:
+            dst.execute("INSERT INTO book_fts (book_fts) VALUES ('rebuild')")
+    dst.execute("VACUUM")
+    dst.close()
+
+
+def synthetic_chunks(books, chunksize):
+    # replaces mdbstream.read_udgave_titel
+    rows = list(mdb_rows(books))
+    for i in range(0, len(rows), chunksize):
+        df = pd.DataFrame(rows[i : i + chunksize])
+        df.index = pd.RangeIndex(i, i + len(df))
+        yield df
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mdb", help="import this mdb file instead of synthetic rows")
+    parser.add_argument(
+        "--catalogue", default=BOOKS_DB, help="the fake services serve these books"
+    )
+    parser.add_argument("--scale", type=int, default=1, help="x books in catalogue")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=mdb_read.WORKERS)
+    parser.add_argument("--batch-size", type=int, default=mdb_read.BATCH_SIZE)
+    parser.add_argument(
+        "--oldump",
+        action="store_true",
+        help="look up openlibrary in a local dump of the catalogue first",
+    )
+    parser.add_argument("--output", help="also write the result to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    proc, base = start_services(args)
+    point_to(base)
+    # retries of the injected errors shouldn't dominate the result
+    helpers.BACKOFF = 0.05
+
+    read_rows = mdb_read.read_rows
+    write_row = mdb_read.write_row
+    latencies = []
+
+    def timed_read_rows(*a, **kw):
+        for job in read_rows(*a, **kw):
+            job["t0"] = time.perf_counter()
+            yield job
+
+    def timed_write_row(job, **kw):
+        res = write_row(job, **kw)
+        latencies.append(time.perf_counter() - job["t0"])
+        return res
+
+    mdb_read.read_rows = timed_read_rows
+    mdb_read.write_row = timed_write_row
+    books = catalogue(args.catalogue, args.scale)
+    if not args.mdb:
+        mdb_read.mdb.list_tables = lambda db_filename: []
+        mdb_read.mdbstream.read_udgave_titel = lambda db_filename, chunksize: (
+            synthetic_chunks(books, chunksize)
+        )
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "books.sqlite")
+            empty_db(args.catalogue, db)
+            dump_db = ""
+            if args.oldump:
+                dump_db = os.path.join(tmp, "oldump.sqlite")
+                dump = os.path.join(tmp, "ol_dump.txt")
+                with open(dump, "w") as f:
+                    f.writelines(ol_dump_lines(books))
+                conn = sqlite3.connect(dump_db)
+                oldump.ingest(conn, dump)
+                conn.close()
+            argv = [
+                "--db",
+                db,
+                "--mdb",
+                args.mdb or "synthetic.mdb",
+                "--workers",
+                str(args.workers),
+                "--batch-size",
+                str(args.batch_size),
+                "--no-cache",
+                "--metrics",
+                "",
+                "--oldump",
+                dump_db,
+            ]
+            start = time.perf_counter()
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                stats = mdb_read.main(argv)
+            seconds = time.perf_counter() - start
+        with urlopen(f"{base}/stats") as resp:
+            services = json.load(resp)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    # the /stats request itself is not part of the import
+    requests = services["requests"] - 1
+    rows = stats["read"]
+    result = {
+        "source": args.mdb or f"synthetic x{args.scale}",
+        "workers": args.workers,
+        "batch_size": args.batch_size,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "rows": rows,
+        "written": len(latencies),
+        "failed": stats["failed"],
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+        "row_latency_ms": {
+            f"p{p}": round(1000 * percentile(latencies, p), 1) if latencies else None
+            for p in (50, 95, 99)
+        },
+        "requests": requests,
+        "requests_per_book": round(requests / rows, 3) if rows else None,
+        "service_errors": services["errors"],
+        "oldump": METRICS.summary()["counters"].get("oldump", {}),
+        "stage_mean_ms": {
+            stage: s["mean_ms"] for stage, s in METRICS.summary()["stages"].items()
+        },
+        # ru_maxrss is in kB on linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
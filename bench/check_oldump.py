@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""Check oldump.py against the small sample dump, without the network.
+
+bench/sample_ol_dump.txt.gz holds a few authors, works and editions, in the
+format of the openlibrary dumps. The script ingests it with and without the
+language and subject filters, checks the isbn, olid and title lookups, and that
+`openlapi.query` and `search_book` use the dump, and only ask the service
+(`fake_services.py`) for what is not in the dump.
+
+Run from the root of the repo
+python bench/check_oldump.py
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers  # noqa: E402
+import oldump  # noqa: E402
+import openlapi  # noqa: E402
+from bench_import import point_to, start_services  # noqa: E402
+from fake_services import BOOKS_DB, catalogue  # noqa: E402
+
+SAMPLE_DUMP = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sample_ol_dump.txt.gz"
+)
+
+
+def build(filename, **filters):
+    """Ingest the sample dump into filename. Returns (counts, olids)"""
+    conn = sqlite3.connect(filename)
+    counts = oldump.ingest(conn, SAMPLE_DUMP, **filters)
+    olids = {olid for (olid,) in conn.execute("SELECT olid FROM record")}
+    conn.close()
+    return counts, olids
+
+
+def check_filters(tmp):
+    counts, olids = build(os.path.join(tmp, "all.sqlite"))
+    assert counts == {"author": 4, "work": 3, "edition": 7}, counts
+
+    # works have no language, and neither has OL7M
+    _, olids = build(os.path.join(tmp, "dan.sqlite"), languages=["dan"])
+    assert olids == {"OL1W", "OL2W", "OL3W", "OL2M", "OL5M", "OL7M"}, olids
+
+    # the editions of the mountaineering works have no subjects of their own.
+    # OL5M has no work, but a matching subject
+    counts, olids = build(
+        os.path.join(tmp, "mountain.sqlite"), subjects=["mountain"]
+    )
+    assert olids == {"OL1W", "OL2W", "OL1M", "OL2M", "OL3M", "OL7M", "OL5M"}, olids
+    # the authors are never filtered
+    assert counts["author"] == 4, counts
+    print("filters ok")
+
+
+def check_lookups(dump):
+    for isbn in ("0340014296", "9780340014295"):
+        edition = dump.by_isbn(isbn)
+        assert edition["key"] == "/books/OL1M", edition
+        assert edition["authors"] == [{"name": "Eric Shipton"}], edition
+    assert dump.by_isbn("9780000000002") is None
+
+    edition = dump.edition("OL2M")
+    assert edition["subtitle"] == "Eigers nordvæg", edition
+    assert dump.edition("OL2W") is None
+
+    doc = dump.search("die weisse spinne", "heinrich harrer")
+    assert doc["key"] == "/works/OL2W", doc
+    doc = dump.search("Tinder og toppe", "Ib Spang Olsen")
+    assert doc["key"] == "/books/OL5M", doc
+    assert dump.search("Die weisse Spinne", "Julia Child") == {}
+
+    keys = [entry["key"] for entry in dump.work_editions("OL2W")]
+    assert keys == ["/books/OL2M", "/books/OL3M"], keys
+    print("lookups ok")
+
+
+def check_fallback(dump_db, books_db):
+    """openlapi uses the dump, and asks the service on a miss"""
+
+    class Args:
+        catalogue = books_db
+        scale = 1
+        latency = 0.0
+        error_rate = 0.0
+
+    proc, base = start_services(Args)
+    point_to(base)
+    helpers.USE_CACHE = False
+    oldump.DUMP_DB = dump_db
+
+    last = [0]
+
+    def new_requests():
+        # the requests since the last call, not counting the /stats requests
+        with urlopen(f"{base}/stats") as resp:
+            total = json.load(resp)["requests"]
+        n, last[0] = total - last[0] - 1, total
+        return n
+
+    try:
+        book = openlapi.query("0340014296")
+        assert book["title"] == "Upon that mountain", book
+        book = openlapi.create_book(
+            {"title": "Die weisse Spinne", "authors": ["Heinrich Harrer"]}
+        )
+        olid, doc = openlapi.search_book(book)
+        assert olid == "OL2W", doc
+        assert new_requests() == 0
+
+        online = next(b for b in catalogue(books_db) if b["online"] and b["isbn"])
+        book = openlapi.query(online["isbn"])
+        assert book["title"] == online["title"], book
+        assert new_requests() == 1
+        book = openlapi.create_book(
+            {"title": online["title"], "authors": online["authors"]}
+        )
+        openlapi.search_book(book)
+        assert new_requests() == 1
+    finally:
+        proc.terminate()
+        proc.wait()
+    print("fallback ok")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--catalogue", default=BOOKS_DB, help="the fake services serve these books"
+    )
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        check_filters(tmp)
+        dump_db = os.path.join(tmp, "all.sqlite")
+        dump = oldump.OLDump(dump_db)
+        check_lookups(dump)
+        dump.close()
+        check_fallback(dump_db, args.catalogue)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the openlibrary and google books services.
+
+Serves the endpoints used by `openlapi` and `googleapi`
+
+    /api/books?bibkeys=ISBN:..,OLID:..    openlibrary books api
+    /search.json?title=..&author=..       openlibrary search
+    /works/<olid>/editions.json           editions of a work
+    /books/v1/volumes?q=isbn:..           google books
+
+The responses are built from a catalogue of books (see `catalogue`), in the
+same format as the real services. Each response can be delayed and a part of
+the requests can fail with `503`, to see how the import handles a slow or
+flaky service.
+
+python bench/fake_services.py --port 8080 --latency 0.2 --error-rate 0.01
+
+The catalogue can also be written as a small openlibrary dump, for `oldump.py`
+python bench/fake_services.py --write-dump sample_dump.txt.gz
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookdb import isbn13_list  # noqa: E402
+from dbkkapi import COUNTRY_TABLE, LOC_TABLE  # noqa: E402
+
+LOGGER = logging.getLogger(__name__)
+
+BOOKS_DB = "books.sqlite"
+# part of the books the services have no data for
+MISS_RATE = 0.2
+# part of the books without isbn in the synthetic mdb rows
+NO_ISBN_RATE = 0.1
+
+
+def isbn10_check_digit(digits):
+    total = sum((10 - i) * int(d) for i, d in enumerate(digits))
+    check = (11 - total % 11) % 11
+    return "X" if check == 10 else str(check)
+
+
+def _words(s):
+    return " ".join(re.findall(r"\w+", (s or "").lower()))
+
+
+def catalogue(books_db=BOOKS_DB, scale=1):
+    """Return a list of books as dicts, built from books_db.
+
+    Each book in the DB gives scale books. Copies get a new isbn and a numbered
+    title. The list is the same for the same books_db and scale, so the server
+    and the synthetic mdb rows agree."""
+    conn = sqlite3.connect(f"file:{books_db}?mode=ro", uri=True)
+    rows = conn.execute(
+        "SELECT id, title, authors, publisher, publish_date, number_of_pages, "
+        "language, isbn, isbn_10, isbn_13 FROM book ORDER BY id"
+    ).fetchall()
+    conn.close()
+
+    books = []
+    for copy in range(scale):
+        for row in rows:
+            book_id, title, authors, publisher, date, pages, language = row[:7]
+            n = copy * len(rows) + book_id
+            if copy:
+                title = f"{title} ({copy})"
+                digits = f"{n:09d}"[-9:]
+                isbn = digits + isbn10_check_digit(digits)
+            else:
+                isbns = isbn13_list(*row[7:])
+                isbn = (row[7] or row[8] or row[9] or "").split("; ")[0]
+                isbn = isbn if isbns else ""
+            # stable pseudo random per book
+            h = zlib.crc32(f"{n}".encode()) / 2 ** 32
+            books.append(
+                {
+                    "n": n,
+                    "isbn": "" if h < NO_ISBN_RATE else isbn,
+                    "online": h >= MISS_RATE,
+                    "title": title or f"Book {n}",
+                    "authors": [a for a in (authors or "").split("; ") if a],
+                    "publisher": publisher or "",
+                    "year": str(date or ""),
+                    "pages": pages or "",
+                    "language": language or "",
+                    "olid": f"OL{n}M",
+                    "work": f"OL{n}W",
+                }
+            )
+    return books
+
+
+def mdb_rows(books):
+    """The books as rows of the joined Udgave/Titel tables of the mdb file"""
+    locations = list(LOC_TABLE)
+    countries = [c for c in COUNTRY_TABLE if isinstance(c, str)]
+    for book in books:
+        beskrivelse = locations[book["n"] % len(locations)]
+        # DBKKs db has the authors as 'last, first'-name
+        authors = [
+            ", ".join(a.rsplit(" ", 1)[::-1]) if " " in a and "," not in a else a
+            for a in book["authors"]
+        ]
+        yield {
+            "Titel": book["title"],
+            "ISBN-nr": book["isbn"],
+            "Forfatter": " og ".join(authors),
+            "Forlag": book["publisher"],
+            "Årstal": book["year"],
+            "Sprog": "Engelsk",
+            "Sideantal": str(book["pages"]),
+            "Beskrivelse": beskrivelse,
+            "Land": countries[book["n"] % len(countries)],
+        }
+
+
+def ol_record(book):
+    # a record as returned by /api/books with jscmd=data
+    isbns = isbn13_list(book["isbn"])
+    return {
+        "url": f"https://openlibrary.org/books/{book['olid']}",
+        "key": f"/books/{book['olid']}",
+        "title": book["title"],
+        "authors": [{"name": a} for a in book["authors"]] or [{"name": ""}],
+        "publishers": [{"name": book["publisher"]}],
+        "publish_date": book["year"],
+        "number_of_pages": book["pages"],
+        "identifiers": {
+            "isbn_10": [book["isbn"]] if len(book["isbn"]) == 10 else [],
+            "isbn_13": isbns,
+            "openlibrary": [book["olid"]],
+        },
+        "subjects": [{"name": "Mountaineering"}],
+        "cover": {"medium": f"https://covers.openlibrary.org/b/id/{book['n']}-M.jpg"},
+    }
+
+
+def ol_dump_lines(books):
+    """Yield the books as lines of an openlibrary dump (see `oldump`), with the
+    authors, works and editions of the books the service has"""
+    authors = {}
+    for book in books:
+        if not book["online"]:
+            continue
+        keys = []
+        for name in book["authors"]:
+            if name not in authors:
+                authors[name] = f"/authors/OL{len(authors) + 1}A"
+                record = {"key": authors[name], "name": name}
+                yield f"/type/author\t{authors[name]}\t1\t\t{json.dumps(record)}\n"
+            keys.append({"key": authors[name]})
+        work = {
+            "key": f"/works/{book['work']}",
+            "title": book["title"],
+            "authors": [{"author": key} for key in keys],
+            "subjects": ["Mountaineering"],
+        }
+        yield f"/type/work\t{work['key']}\t1\t\t{json.dumps(work)}\n"
+        isbn = book["isbn"]
+        edition = {
+            "key": f"/books/{book['olid']}",
+            "title": book["title"],
+            "authors": keys,
+            "works": [{"key": work["key"]}],
+            "isbn_10": [isbn] if len(isbn) == 10 else [],
+            "isbn_13": isbn13_list(isbn),
+            "publishers": [book["publisher"]],
+            "publish_date": book["year"],
+            "number_of_pages": book["pages"],
+            "subjects": ["Mountaineering"],
+            "covers": [book["n"]],
+            "languages": [{"key": "/languages/eng"}],
+        }
+        yield f"/type/edition\t{edition['key']}\t1\t\t{json.dumps(edition)}\n"
+
+
+def google_record(book):
+    ids = [{"type": "ISBN_13", "identifier": i} for i in isbn13_list(book["isbn"])]
+    return {
+        "title": book["title"],
+        "authors": book["authors"],
+        "publisher": book["publisher"],
+        "publishedDate": book["year"],
+        "language": "en",
+        "industryIdentifiers": ids,
+        "pageCount": book["pages"],
+        "categories": ["Sports & Recreation"],
+        "description": "",
+        "imageLinks": {"thumbnail": f"http://books.google.com/{book['n']}.jpg"},
+        "previewLink": "",
+    }
+
+
+class Services:
+    """The lookup tables behind the fake endpoints"""
+
+    def __init__(self, books, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        online = [b for b in books if b["online"]]
+        self.by_key = {}
+        for book in online:
+            for isbn in [book["isbn"]] + isbn13_list(book["isbn"]):
+                if isbn:
+                    self.by_key[f"ISBN:{isbn}"] = book
+            self.by_key[f"OLID:{book['olid']}"] = book
+        self.by_title = {_words(b["title"]): b for b in online}
+        self.by_work = {b["work"]: b for b in online}
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def books_api(self, query):
+        bibkeys = query.get("bibkeys", [""])[0].split(",")
+        return {k: ol_record(self.by_key[k]) for k in bibkeys if k in self.by_key}
+
+    def search(self, query):
+        book = self.by_title.get(_words(query.get("title", [""])[0]))
+        if not book:
+            return {"numFound": 0, "docs": []}
+        doc = {"key": f"/works/{book['work']}", "title": book["title"]}
+        return {"numFound": 1, "docs": [doc]}
+
+    def editions(self, work):
+        book = self.by_work.get(work)
+        if not book:
+            return {"entries": []}
+        entry = {
+            "key": f"/books/{book['olid']}",
+            "publishers": [book["publisher"]],
+            "publish_date": book["year"],
+            "languages": [{"key": "/languages/eng"}],
+        }
+        return {"size": 1, "entries": [entry]}
+
+    def volumes(self, query):
+        q = query.get("q", [""])[0]
+        book = self.by_key.get("ISBN:" + q.replace("isbn:", ""))
+        if not book:
+            return {}
+        return {"items": [{"volumeInfo": google_record(book)}]}
+
+    def respond(self, path):
+        """Return (status, data) for the request path"""
+        with self._lock:
+            self.requests += 1
+            fail = random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if fail:
+            return 503, {}
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if url.path == "/api/books":
+            return 200, self.books_api(query)
+        if url.path == "/search.json":
+            return 200, self.search(query)
+        match = re.match(r"/works/(\w+)/editions.json", url.path)
+        if match:
+            return 200, self.editions(match.group(1))
+        if url.path == "/books/v1/volumes":
+            return 200, self.volumes(query)
+        if url.path == "/stats":
+            return 200, {"requests": self.requests, "errors": self.errors}
+        return 404, {}
+
+
+def make_handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, like the real services
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status, data = services.respond(self.path)
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format, *args)
+
+    return Handler
+
+
+def serve(services, port=0):
+    """Start the server in a thread. Returns the server"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(services))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--db", default=BOOKS_DB, help="the catalogue is built from")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--write-dump", help="write the catalogue as an openlibrary dump and exit"
+    )
+    args = parser.parse_args()
+
+    if args.write_dump:
+        with gzip.open(args.write_dump, "wt", encoding="utf-8") as f:
+            f.writelines(ol_dump_lines(catalogue(args.db, args.scale)))
+        return
+
+    services = Services(catalogue(args.db, args.scale), args.latency, args.error_rate)
+    server = serve(services, args.port)
+    # the benchmark reads the port from the first line
+    print(server.server_port, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
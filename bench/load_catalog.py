@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""Load test of catalog_service.py.
+
+Starts the service on books.sqlite (or uses a running one with --port) and
+sends requests from many keep-alive connections for a number of seconds. The
+paths are isbn lookups of the books in the DB, with a part of unknown isbns,
+and optionally searches and location listings. Prints requests/s and the
+p50/p95/p99 latency as json.
+
+Run from the root of the repo
+python bench/load_catalog.py --seconds 10 --connections 50
+python bench/load_catalog.py --mix isbn=8,search=1,location=1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookdb import isbn13_list  # noqa: E402
+from fake_services import isbn10_check_digit  # noqa: E402
+
+BOOKS_DB = "books.sqlite"
+SERVICE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog_service.py"
+)
+SEARCH_WORDS = ("everest", "k2", "alpine", "messner", "climbing", "himalaya", "ski")
+
+
+def paths(books_db, mix, unknown=0.1):
+    """Return a function giving random request paths"""
+    conn = sqlite3.connect(f"file:{books_db}?mode=ro", uri=True)
+    isbns = [
+        isbns[0]
+        for isbns in (
+            isbn13_list(*row)
+            for row in conn.execute("SELECT isbn, isbn_10, isbn_13 FROM book")
+        )
+        if isbns
+    ]
+    labels = [row[0] for row in conn.execute("SELECT label_name FROM location")]
+    conn.close()
+
+    def isbn():
+        if random.random() < unknown:
+            digits = f"{random.randrange(10**9):09d}"
+            return f"/isbn/{digits}{isbn10_check_digit(digits)}"
+        return f"/isbn/{random.choice(isbns)}"
+
+    kinds = {
+        "isbn": isbn,
+        "search": lambda: f"/search?q={random.choice(SEARCH_WORDS)}&limit=20",
+        "location": lambda: f"/locations/{random.choice(labels)}/books?limit=50",
+    }
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    return lambda: kinds[random.choices(names, weights)[0]]()
+
+
+async def client(host, port, next_path, deadline, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    while time.perf_counter() < deadline:
+        request = f"GET {next_path()} HTTP/1.1\r\nHost: {host}\r\n\r\n"
+        start = time.perf_counter()
+        writer.write(request.encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        length = next(
+            int(line.split(":", 1)[1])
+            for line in lines
+            if line.lower().startswith("content-length:")
+        )
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+        status = lines[0].split(" ")[1]
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def run(host, port, next_path, connections, seconds):
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client(host, port, next_path, deadline, latencies, statuses)
+            for _ in range(connections)
+        )
+    )
+    return latencies, statuses, time.perf_counter() - start
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(host, port, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"the service did not start on port {port}")
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=BOOKS_DB)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="use the service running here")
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument(
+        "--mix", default="isbn=1", help="weights of the requests, eg. isbn=8,search=1"
+    )
+    parser.add_argument("--output", help="also write the result to this file")
+    args = parser.parse_args()
+
+    mix = {k: float(v) for k, v in (kv.split("=") for kv in args.mix.split(","))}
+    next_path = paths(args.db, mix)
+    proc = None
+    port = args.port
+    if port is None:
+        port = free_port()
+        cmd = [sys.executable, SERVICE, "--db", args.db, "--port", str(port)]
+        proc = subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(args.host, port)
+        latencies, statuses, seconds = asyncio.run(
+            run(args.host, port, next_path, args.connections, args.seconds)
+        )
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    latencies.sort()
+    result = {
+        "mix": mix,
+        "connections": args.connections,
+        "requests": len(latencies),
+        "seconds": round(seconds, 3),
+        "requests_per_sec": round(len(latencies) / seconds, 1),
+        "latency_ms": {
+            f"p{p}": round(1000 * percentile(latencies, p), 2) for p in (50, 95, 99)
+        },
+        "statuses": statuses,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import json
+import math
+import re
 import sqlite3
+import unicodedata
+from collections import namedtuple
 from dbkkapi import COUNTRY_TABLE, LOC_TABLE
+from isbnlib import canonical, is_isbn10, is_isbn13, notisbn, to_isbn13
 import argparse
 from _exceptions import RecordMappingError, ISBNNotConsistentError
 import logging
@@ -18,10 +24,12 @@ DELETE FROM book
 """
 
 
-def create_connection(db_file):
+def create_connection(db_file, **kwargs):
+    # kwargs are passed on to sqlite3.connect, eg. check_same_thread=False if
+    # the connection is used from another thread than the one creating it
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, **kwargs)
     except sqlite3.Error as e:
         print(e)
 
@@ -39,6 +47,97 @@ def updatedb(conn, sql, data):
     return cur.lastrowid
 
 
+# status of a row in the import journal
+JOURNAL_DONE = "done"
+JOURNAL_FAILED = "failed"
+JOURNAL_NOT_ONLINE = "not_online"
+
+JOURNAL_SQL = """CREATE TABLE IF NOT EXISTS import_journal (
+        row_key VARCHAR(500) NOT NULL,
+        status VARCHAR(20),
+        error VARCHAR(1000),
+        updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (row_key)
+)"""
+
+
+def create_journal(conn):
+    # the import journal records the status of every row from the mdb file,
+    # so an import can be resumed
+    cur = conn.cursor()
+    cur.execute(JOURNAL_SQL)
+    conn.commit()
+
+
+def get_journal(conn):
+    # returns a dict with row_key -> status mapping
+    sql = "SELECT row_key, status FROM import_journal"
+    cur = conn.cursor()
+    cur.execute(sql)
+    return dict(cur.fetchall())
+
+
+JOURNAL_MARK_SQL = """INSERT OR REPLACE INTO import_journal
+    (row_key, status, error, updated) VALUES(?, ?, ?, CURRENT_TIMESTAMP)"""
+
+
+def journal_mark(conn, row_key, status, error=""):
+    return updatedb(conn, JOURNAL_MARK_SQL, (row_key, status, str(error)[:1000]))
+
+
+# Scans of isbns not in the DB, one row per scan. Rows are only appended, and
+# committed per scan, so a crash loses at most the scan being written. The
+# location of an isbn is the one of its last scan.
+SCAN_EVENT_SQL = """
+CREATE TABLE IF NOT EXISTS scan_event (
+        id INTEGER NOT NULL,
+        isbn VARCHAR(20) NOT NULL,
+        location INTEGER,
+        scanned TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id),
+        FOREIGN KEY(location) REFERENCES location (id)
+);
+CREATE INDEX IF NOT EXISTS scan_event_isbn ON scan_event (isbn);
+"""
+
+
+def add_scan_event(conn, isbn, location):
+    sql = "INSERT INTO scan_event (isbn, location) VALUES(?, ?)"
+    return updatedb(conn, sql, (isbn, location))
+
+
+def get_scanned_isbns(conn):
+    """Return a dict isbn -> location of the last scan.
+
+    The isbns are in the order they were first scanned"""
+    scanned = {}
+    for isbn, location in conn.execute(
+        "SELECT isbn, location FROM scan_event ORDER BY id"
+    ):
+        scanned[isbn] = location
+    return scanned
+
+
+def compact_scan_events(conn):
+    """Remove all but the last scan of each isbn. Returns the number removed"""
+    cur = conn.execute(
+        "DELETE FROM scan_event WHERE id NOT IN "
+        "(SELECT max(id) FROM scan_event GROUP BY isbn)"
+    )
+    conn.commit()
+    return cur.rowcount
+
+
+def import_scanned_isbns(conn, scanned):
+    """Append a scan for each isbn -> location in scanned, eg. from the old
+    unknown_barcodes.pickle, unless the isbn is already in scan_event"""
+    known = set(get_scanned_isbns(conn))
+    data = [(isbn, loc) for isbn, loc in scanned.items() if isbn not in known]
+    with conn:
+        conn.executemany("INSERT INTO scan_event (isbn, location) VALUES(?, ?)", data)
+    return len(data)
+
+
 def create_locations(conn):
     # populate locations in database
     sql = "INSERT INTO location(label_name, full_name) VALUES(?,?)"
@@ -98,22 +197,985 @@ def book_exist(conn, data_dict, all_true=True, return_bool=True):
     return res
 
 
+# do this a bit more dynamically
+# https://stackoverflow.com/a/39361069
+INSERT_SQL = """INSERT {conflict} INTO book
+    (isbn, isbn_10, isbn_13, olid, goodreads, lccn, oclc, title, authors,
+    publisher, publish_date, number_of_pages, subjects,
+    openlibrary_medcover_url, location, language, openlibrary_preview_url,
+    description, publish_year, pages)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) """
+
+# A book is the same if it has the same isbn or the same title and authors.
+# With these indexes, `INSERT OR IGNORE` skips books already in the DB.
+UNIQUE_INDEX_SQL = """
+CREATE UNIQUE INDEX IF NOT EXISTS book_title_authors ON book (title, authors);
+CREATE UNIQUE INDEX IF NOT EXISTS book_unique_isbn ON book (isbn) WHERE isbn != '';
+"""
+
+# The isbn columns can hold several "; "-joined isbns. book_isbn holds every
+# isbn of a book, as isbn13, so a book can be found by any of its isbns using
+# the index.
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS book_isbn (
+        book_id INTEGER NOT NULL,
+        isbn13 VARCHAR(13) NOT NULL,
+        PRIMARY KEY (isbn13, book_id),
+        FOREIGN KEY(book_id) REFERENCES book (id)
+);
+CREATE INDEX IF NOT EXISTS book_isbn_book_id ON book_isbn (book_id);
+CREATE INDEX IF NOT EXISTS book_olid ON book (olid);
+CREATE INDEX IF NOT EXISTS book_location ON book (location);
+"""
+
+# The authors and subjects of the books, one row per name. The book columns
+# hold them "; "-joined. name_key is the name normalized for comparison, see
+# name_key(), so "Shipton, Eric" and "Eric Shipton" are the same author.
+NAMES_SQL = """
+CREATE TABLE IF NOT EXISTS author (
+        id INTEGER NOT NULL,
+        name VARCHAR(200) NOT NULL,
+        name_key VARCHAR(200) NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (name_key)
+);
+CREATE TABLE IF NOT EXISTS book_author (
+        book_id INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        position INTEGER,
+        PRIMARY KEY (book_id, author_id),
+        FOREIGN KEY(book_id) REFERENCES book (id),
+        FOREIGN KEY(author_id) REFERENCES author (id)
+);
+CREATE INDEX IF NOT EXISTS book_author_author ON book_author (author_id, book_id);
+CREATE TABLE IF NOT EXISTS subject (
+        id INTEGER NOT NULL,
+        name VARCHAR(200) NOT NULL,
+        name_key VARCHAR(200) NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (name_key)
+);
+CREATE TABLE IF NOT EXISTS book_subject (
+        book_id INTEGER NOT NULL,
+        subject_id INTEGER NOT NULL,
+        position INTEGER,
+        PRIMARY KEY (book_id, subject_id),
+        FOREIGN KEY(book_id) REFERENCES book (id),
+        FOREIGN KEY(subject_id) REFERENCES subject (id)
+);
+CREATE INDEX IF NOT EXISTS book_subject_subject ON book_subject (subject_id, book_id);
+"""
+# table -> the book column with the names
+NAME_COLUMNS = {"author": "authors", "subject": "subjects"}
+
+# Full-text search over the books. book_fts is an external content FTS5 table,
+# ie. it only holds the index, the text is read from book_search. remove_diacritics
+# makes "muller" find "Müller", but ø/æ/ß are letters of their own to unicode61,
+# so book_search adds a column with those folded, and "bjorn" finds "Bjørn".
+# The triggers keep the index current on every change to book, also when the DB
+# is written by other tools.
+FOLD = (("ø", "o"), ("Ø", "O"), ("æ", "ae"), ("Æ", "AE"), ("ß", "ss"),
+        ("œ", "oe"), ("Œ", "OE"))
+FTS_COLUMNS = ("title", "authors", "publisher", "subjects", "description")
+# bm25 weights of the columns and the folded column
+FTS_WEIGHTS = (10.0, 5.0, 1.0, 2.0, 1.0, 1.0)
+
+
+def _fold(prefix):
+    # sql for all the columns joined, with the letters in FOLD replaced
+    sql = " || ' ' || ".join(f"coalesce({prefix}{col}, '')" for col in FTS_COLUMNS)
+    for a, b in FOLD:
+        sql = f"replace({sql}, '{a}', '{b}')"
+    return sql
+
+
+def _fts_values(prefix):
+    return ", ".join(f"{prefix}{col}" for col in FTS_COLUMNS) + ", " + _fold(prefix)
+
+
+FTS_SQL = f"""
+CREATE VIEW IF NOT EXISTS book_search AS
+    SELECT id, {", ".join(FTS_COLUMNS)}, {_fold("")} AS folded FROM book;
+CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        {", ".join(FTS_COLUMNS)}, folded,
+        content='book_search', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN
+    INSERT INTO book_fts (rowid, {", ".join(FTS_COLUMNS)}, folded)
+        VALUES (new.id, {_fts_values("new.")});
+END;
+CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN
+    INSERT INTO book_fts (book_fts, rowid, {", ".join(FTS_COLUMNS)}, folded)
+        VALUES ('delete', old.id, {_fts_values("old.")});
+END;
+CREATE TRIGGER IF NOT EXISTS book_fts_update
+AFTER UPDATE OF {", ".join(FTS_COLUMNS)} ON book BEGIN
+    INSERT INTO book_fts (book_fts, rowid, {", ".join(FTS_COLUMNS)}, folded)
+        VALUES ('delete', old.id, {_fts_values("old.")});
+    INSERT INTO book_fts (rowid, {", ".join(FTS_COLUMNS)}, folded)
+        VALUES (new.id, {_fts_values("new.")});
+END;
+"""
+
+# Schema versions, stored in PRAGMA user_version. migrate() runs the
+# migrations newer than the version of the DB, in order.
+# 1: book_isbn, every isbn of a book as isbn13, see SCHEMA_SQL.
+# 2: scan_event, the scans of isbns not in the DB, see SCAN_EVENT_SQL.
+# 3: the full-text search index, see FTS_SQL.
+# 4: the author and subject tables, see NAMES_SQL.
+# 5: typed publish_year and pages, from publish_date and number_of_pages, and
+#    the in_lib column used by the barcode scanner. With indexes, so eg. books
+#    from 1950-1970 with more than 300 pages is a range scan.
+MIGRATION_5_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS book_publish_year ON book (publish_year);
+CREATE INDEX IF NOT EXISTS book_pages ON book (pages);
+CREATE INDEX IF NOT EXISTS book_in_lib ON book (in_lib, location);
+"""
+# books backfilled per transaction
+MIGRATION_CHUNK_SIZE = 5000
+# years outside are no publish year, eg. "1" from a bad date
+YEARS = (1400, 2100)
+
+
+def parse_year(date):
+    """The year of a publish date, eg. 'ca. 1911' -> 1911, or None"""
+    match = re.search(r"\d{4}", str(date or ""))
+    if match and YEARS[0] <= int(match.group(0)) <= YEARS[1]:
+        return int(match.group(0))
+    return None
+
+
+def parse_pages(pages):
+    """The number of pages, eg. '300 p.' -> 300, or None"""
+    match = re.search(r"\d+", str(pages or ""))
+    if match and int(match.group(0)) > 0:
+        return int(match.group(0))
+    return None
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _migration_1(conn, chunk_size):
+    conn.executescript(SCHEMA_SQL)
+    if conn.execute("SELECT count(*) FROM book_isbn").fetchone()[0] == 0:
+        sync_book_isbns(conn)
+        conn.commit()
+
+
+def _migration_2(conn, chunk_size):
+    conn.executescript(SCAN_EVENT_SQL)
+
+
+def _migration_3(conn, chunk_size):
+    create_search_index(conn)
+
+
+def _migration_4(conn, chunk_size):
+    conn.executescript(NAMES_SQL)
+    if conn.execute("SELECT count(*) FROM book_author").fetchone()[0] == 0:
+        sync_book_names(conn)
+        conn.commit()
+
+
+def _migration_5(conn, chunk_size):
+    columns = _columns(conn, "book")
+    for column in ("publish_year", "pages", "in_lib"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE book ADD COLUMN {column} INTEGER")
+    conn.executescript(MIGRATION_5_INDEX_SQL)
+    conn.create_function("parse_year", 1, parse_year, deterministic=True)
+    conn.create_function("parse_pages", 1, parse_pages, deterministic=True)
+    first, last = conn.execute("SELECT min(id), max(id) FROM book").fetchone()
+    if first is None:
+        return
+    for start in range(first, last + 1, chunk_size):
+        with conn:
+            conn.execute(
+                "UPDATE book SET publish_year = parse_year(publish_date), "
+                "pages = parse_pages(number_of_pages) WHERE id BETWEEN ? AND ?",
+                (start, start + chunk_size - 1),
+            )
+
+
+# 6: a trigram index of the titles, to find a book already in the DB under a
+#    slightly different title or authors, eg. 'Bjergenes erobring' by 'Shipton,
+#    Eric' for 'Bjergenes Erobring' by 'Eric Shipton'. See find_similar_book.
+FUZZY_SQL = """
+CREATE TABLE IF NOT EXISTS book_fuzzy (
+        book_id INTEGER NOT NULL,
+        authors_key VARCHAR(200),
+        trigrams INTEGER,
+        title_trigrams TEXT,
+        PRIMARY KEY (book_id),
+        FOREIGN KEY(book_id) REFERENCES book (id)
+);
+CREATE TABLE IF NOT EXISTS book_trigram (
+        trigram VARCHAR(3) NOT NULL,
+        book_id INTEGER NOT NULL,
+        PRIMARY KEY (trigram, book_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS book_trigram_book_id ON book_trigram (book_id);
+CREATE TABLE IF NOT EXISTS trigram_count (
+        trigram VARCHAR(3) NOT NULL,
+        books INTEGER NOT NULL,
+        PRIMARY KEY (trigram)
+) WITHOUT ROWID;
+"""
+# min. similarity (jaccard of the trigrams) of the titles and the authors
+FUZZY_THRESHOLD = 0.6
+# the candidates compared on all trigrams by find_similar_book
+FUZZY_CANDIDATES = 10
+# joins the trigrams of a title in book_fuzzy.title_trigrams, never in a trigram
+GRAM_SEP = "|"
+
+
+def fuzzy_key(s):
+    """Normalize s for fuzzy matching: no case, accents or punctuation"""
+    s = unicodedata.normalize("NFKD", str(s or ""))
+    for a, b in FOLD:
+        s = s.replace(a, b)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", s.casefold()).split())
+
+
+def trigrams(s):
+    """The set of trigrams of the words in s, padded like in pg_trgm, so
+    'K2' -> {'  k', ' k2', 'k2 '}"""
+    grams = set()
+    for word in fuzzy_key(s).split():
+        word = f"  {word} "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def similarity(a, b):
+    """Jaccard similarity of the trigrams of a and b. 1.0 if both are empty"""
+    ta, tb = trigrams(a), trigrams(b)
+    if not ta and not tb:
+        return 1.0
+    return len(ta & tb) / len(ta | tb)
+
+
+def _number_grams(grams):
+    # the trigrams with a digit, eg. of the volume number in a title
+    return {gram for gram in grams if any(c.isdigit() for c in gram)}
+
+
+def _fuzzy_authors(authors):
+    # the authors in a fixed order, see authors_key
+    return fuzzy_key(" ".join(authors_key(authors)))
+
+
+def sync_book_trigrams(conn, min_id=None, book_ids=None, max_id=None):
+    """Update the trigram index for the books as in `sync_book_isbns`, or the
+    books with min_id < id <= max_id.
+
+    The caller commits"""
+    rows = _book_rows(conn, "id, title, authors", min_id, book_ids, max_id)
+    ids = [(row[0],) for row in rows]
+    conn.executemany(
+        "UPDATE trigram_count SET books = books - 1 WHERE trigram IN "
+        "(SELECT trigram FROM book_trigram WHERE book_id = ?)",
+        ids,
+    )
+    conn.executemany("DELETE FROM book_trigram WHERE book_id = ?", ids)
+    conn.executemany("DELETE FROM book_fuzzy WHERE book_id = ?", ids)
+    fuzzy, grams = [], []
+    for book_id, title, authors in rows:
+        title_grams = trigrams(title)
+        fuzzy.append(
+            (
+                book_id,
+                _fuzzy_authors(authors),
+                len(title_grams),
+                GRAM_SEP.join(sorted(title_grams)),
+            )
+        )
+        grams.extend((gram, book_id) for gram in title_grams)
+    conn.executemany(
+        "INSERT INTO book_fuzzy (book_id, authors_key, trigrams, title_trigrams) "
+        "VALUES(?, ?, ?, ?)",
+        fuzzy,
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO book_trigram (trigram, book_id) VALUES(?, ?)", grams
+    )
+    conn.executemany(
+        "INSERT INTO trigram_count (trigram, books) VALUES(?, 1) "
+        "ON CONFLICT (trigram) DO UPDATE SET books = books + 1",
+        [(gram,) for gram, _ in grams],
+    )
+
+
+def find_similar_book(
+    conn, title, authors, threshold=FUZZY_THRESHOLD, candidates=FUZZY_CANDIDATES
+):
+    """Return (book_id, similarity) of the book most like title and authors, or
+    None if no book is at least threshold similar in both.
+
+    A book at least threshold similar to title shares `need` of its trigrams,
+    so it has one of the len - need + 1 rarest of them. The candidates are the
+    books with the most of these rare trigrams, which are few whatever the size
+    of the catalogue, and only they are compared on all trigrams.
+
+    The numbers in the titles must be the same, so volume 1 and 2 of a book
+    are different books"""
+    grams = trigrams(title)
+    if not grams:
+        return None
+    numbers = _number_grams(grams)
+    need = max(1, math.ceil(threshold * len(grams)))
+    marks = ", ".join("?" * len(grams))
+    counts = dict(
+        conn.execute(
+            f"SELECT trigram, books FROM trigram_count WHERE trigram IN ({marks})",
+            list(grams),
+        )
+    )
+    rare = sorted(grams, key=lambda gram: (counts.get(gram, 0), gram))
+    rare = [gram for gram in rare[: len(grams) - need + 1] if counts.get(gram)]
+    if not rare:
+        return None
+    key = _fuzzy_authors(authors)
+    best = None
+    for book_id, book_grams, book_authors in conn.execute(
+        "SELECT f.book_id, f.title_trigrams, f.authors_key FROM "
+        "(SELECT book_id, count(*) AS hits FROM book_trigram "
+        f"WHERE trigram IN ({', '.join('?' * len(rare))}) GROUP BY book_id) t "
+        "JOIN book_fuzzy f ON f.book_id = t.book_id "
+        "WHERE f.trigrams BETWEEN ? AND ? "
+        "ORDER BY t.hits DESC, t.book_id LIMIT ?",
+        [*rare, threshold * len(grams), len(grams) / threshold, candidates],
+    ):
+        book_grams = book_grams.split(GRAM_SEP)
+        shared = len(grams.intersection(book_grams))
+        sim = shared / (len(grams) + len(book_grams) - shared)
+        if sim < threshold or (best and sim <= best[1]):
+            continue
+        if numbers != _number_grams(book_grams):
+            continue
+        if key == book_authors or similarity(key, book_authors) >= threshold:
+            best = (book_id, sim)
+    return best
+
+
+def _migration_6(conn, chunk_size):
+    conn.executescript(FUZZY_SQL)
+    first, last = conn.execute("SELECT min(id), max(id) FROM book").fetchone()
+    if first is None:
+        return
+    for start in range(first, last + 1, chunk_size):
+        with conn:
+            sync_book_trigrams(conn, min_id=start - 1, max_id=start + chunk_size - 1)
+
+
+# 7: the covers downloaded by covers.py. A cover is stored once per content
+#    (sha256), with its resized variants; book_cover links the books to it.
+#    The paths are relative to the covers directory
+COVER_SQL = """
+CREATE TABLE IF NOT EXISTS cover (
+        sha256 VARCHAR(64) NOT NULL,
+        path VARCHAR(100),
+        small_path VARCHAR(100),
+        medium_path VARCHAR(100),
+        width INTEGER,
+        height INTEGER,
+        size INTEGER,
+        PRIMARY KEY (sha256)
+);
+CREATE TABLE IF NOT EXISTS book_cover (
+        book_id INTEGER NOT NULL,
+        url VARCHAR(200),
+        sha256 VARCHAR(64),
+        status VARCHAR(10),
+        error TEXT,
+        fetched REAL,
+        PRIMARY KEY (book_id),
+        FOREIGN KEY(book_id) REFERENCES book (id),
+        FOREIGN KEY(sha256) REFERENCES cover (sha256)
+);
+CREATE INDEX IF NOT EXISTS book_cover_url ON book_cover (url);
+"""
+
+
+def _migration_7(conn, chunk_size):
+    conn.executescript(COVER_SQL)
+
+
+# 8: the unique indexes, see UNIQUE_INDEX_SQL. They fail if the DB contains
+#    duplicate books, so they are the last migration: such a DB is migrated as
+#    far as it can be, and can still be used, eg. by the barcode scanner.
+def _migration_8(conn, chunk_size):
+    create_unique_indexes(conn)
+
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, chunk_size=MIGRATION_CHUNK_SIZE):
+    """Run the migrations newer than the schema version of the DB.
+
+    A migration is safe to run again, so if one is interrupted it is run
+    again from the start next time. Returns the new version. Raises
+    sqlite3.IntegrityError, if the DB contains duplicate books, see
+    `find_duplicates`"""
+    version = schema_version(conn)
+    for target, migration in MIGRATIONS:
+        if version >= target:
+            continue
+        LOGGER.info("migrating the DB from version %s to %s", version, target)
+        migration(conn, chunk_size)
+        # user_version is only set when the migration is done
+        with conn:
+            conn.execute(f"PRAGMA user_version = {target}")
+        version = target
+    return version
+
+
+SEARCH_LIMIT = 20
+SEARCH_SQL = """SELECT b.id, b.title, b.authors, l.label_name,
+        bm25(book_fts, {weights}) AS score,
+        snippet(book_fts, -1, '[', ']', '...', 12)
+    FROM book_fts
+    JOIN book b ON b.id = book_fts.rowid
+    LEFT JOIN location l ON l.id = b.location
+    WHERE book_fts MATCH ? {where}
+    ORDER BY score, b.id
+    LIMIT ?"""
+
+# score: bm25, lower is better. location is the label_name, eg. '5' or '2.N'
+SearchHit = namedtuple("SearchHit", "id title authors location score snippet")
+
+# number of books written in one transaction by BookWriter
+BATCH_SIZE = 500
+
+
+def create_unique_indexes(conn):
+    # fails with sqlite3.IntegrityError if the DB already contains duplicates
+    try:
+        conn.executescript(UNIQUE_INDEX_SQL)
+    except sqlite3.IntegrityError:
+        LOGGER.error("duplicate books in the DB. Remove them before importing")
+        raise
+
+
+def find_duplicates(conn):
+    """Return the books preventing the unique indexes, as a list of
+    ('isbn', isbn, ids) and ('title', (title, authors), ids)"""
+    dups = [
+        ("isbn", isbn, ids)
+        for isbn, ids in conn.execute(
+            "SELECT isbn, group_concat(id, ', ') FROM book WHERE isbn != '' "
+            "GROUP BY isbn HAVING count(*) > 1"
+        )
+    ]
+    dups.extend(
+        ("title", (title, authors), ids)
+        for title, authors, ids in conn.execute(
+            "SELECT title, authors, group_concat(id, ', ') FROM book "
+            "GROUP BY title, authors HAVING count(*) > 1"
+        )
+    )
+    return dups
+
+
+def upgrade_schema(conn):
+    """Bring an existing DB up to the current schema, see MIGRATIONS.
+
+    Safe to run more than once"""
+    migrate(conn)
+
+
+def create_search_index(conn):
+    """Create the full-text index and its triggers, and index all books if new"""
+    new = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'book_fts'"
+    ).fetchone()
+    conn.executescript(FTS_SQL)
+    if new:
+        with conn:
+            conn.execute("INSERT INTO book_fts (book_fts) VALUES ('rebuild')")
+        LOGGER.info("created the search index")
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching all words.
+
+    Each word is quoted, so punctuation in titles is no FTS5 syntax, and the
+    last word is a prefix, eg. 'K2 - savage mount' -> '"K2" "savage" "mount"*'"""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    return " ".join(f'"{w}"' for w in words) + "*"
+
+
+def search(conn, query, limit=SEARCH_LIMIT, location=None, raw=False, after=None):
+    """Return the best matching books for query as a list of SearchHit.
+
+    The books are ranked by bm25, with title and authors weighted most. A
+    location (label_name, eg. '5' or '2.N') limits the search to that shelf.
+    With raw, query is passed on as FTS5 syntax, eg. 'authors:messner AND k2'.
+    For the next page, pass the (score, id) of the last hit as after"""
+    match = query if raw else fts_query(query)
+    if not match:
+        return []
+    where, params = "", [match]
+    if location is not None:
+        where = "AND l.label_name = ?"
+        params.append(str(location))
+    if after is not None:
+        score, book_id = after
+        where += " AND (score > ? OR (score = ? AND b.id > ?))"
+        params += [score, score, book_id]
+    weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+    sql = SEARCH_SQL.format(weights=weights, where=where)
+    rows = conn.execute(sql, params + [limit]).fetchall()
+    return [SearchHit(*row) for row in rows]
+
+
+def isbn13_list(*isbns):
+    """Return all valid isbns in the "; "-joined strings as isbn13"""
+    res = []
+    for isbn in isbns:
+        for s in (isbn or "").split("; "):
+            s = canonical(s)
+            if is_isbn10(s):
+                s = to_isbn13(s)
+            elif not is_isbn13(s):
+                continue
+            if s not in res:
+                res.append(s)
+    return res
+
+
+def _book_rows(conn, columns, min_id=None, book_ids=None, max_id=None):
+    # all books, the books with min_id < id (<= max_id) or the books in book_ids
+    sql = f"SELECT {columns} FROM book"
+    if min_id is not None and max_id is not None:
+        return conn.execute(
+            sql + " WHERE id > ? AND id <= ?", (min_id, max_id)
+        ).fetchall()
+    if min_id is not None:
+        return conn.execute(sql + " WHERE id > ?", (min_id,)).fetchall()
+    if book_ids is not None:
+        rows = [
+            conn.execute(sql + " WHERE id = ?", (book_id,)).fetchone()
+            for book_id in book_ids
+        ]
+        return [row for row in rows if row]
+    return conn.execute(sql).fetchall()
+
+
+def sync_book_isbns(conn, min_id=None, book_ids=None):
+    """Update book_isbn from the isbn columns of book.
+
+    Updates all books, the books with id > min_id or the books in book_ids.
+    The caller commits"""
+    rows = _book_rows(conn, "id, isbn, isbn_10, isbn_13", min_id, book_ids)
+    ids = [(row[0],) for row in rows]
+    data = [(row[0], isbn13) for row in rows for isbn13 in isbn13_list(*row[1:])]
+    conn.executemany("DELETE FROM book_isbn WHERE book_id = ?", ids)
+    conn.executemany(
+        "INSERT OR IGNORE INTO book_isbn (book_id, isbn13) VALUES(?, ?)", data
+    )
+
+
+def _valid_isbns(isbns):
+    # the valid/invalid isbns of a "; "-joined string
+    valid, invalid = [], []
+    for s in (isbns or "").split("; "):
+        if s:
+            (invalid if notisbn(s) else valid).append(s)
+    return valid, invalid
+
+
+def register_isbn_functions(conn):
+    """Make the isbn functions of isbnlib usable in sql on conn.
+
+    valid_isbn(s)           1 if s is a valid isbn10/13
+    to_isbn13s(s)           the valid isbns of "; "-joined s as "; "-joined isbn13
+    isbn13_json(a, b, ..)   json array of all valid isbns as isbn13, see isbn13_list
+    invalid_isbns_json(s)   json array of the invalid isbns in "; "-joined s
+
+    UPDATE book SET isbn_13 = to_isbn13s(isbn_10) WHERE isbn_13 = ''
+    """
+    conn.create_function(
+        "valid_isbn", 1, lambda s: int(bool(s) and not notisbn(s)), deterministic=True
+    )
+    conn.create_function(
+        "to_isbn13s",
+        1,
+        lambda s: "; ".join(to_isbn13(i) for i in _valid_isbns(s)[0]),
+        deterministic=True,
+    )
+    conn.create_function(
+        "isbn13_json",
+        -1,
+        lambda *isbns: json.dumps(isbn13_list(*isbns)),
+        deterministic=True,
+    )
+    conn.create_function(
+        "invalid_isbns_json",
+        1,
+        lambda s: json.dumps(_valid_isbns(s)[1]),
+        deterministic=True,
+    )
+
+
+def sync_book_isbn_range(conn, first_id, last_id):
+    """Update book_isbn for the books with first_id <= id <= last_id in sql,
+    without reading the books into python. Needs register_isbn_functions.
+
+    The caller commits"""
+    conn.execute(
+        "DELETE FROM book_isbn WHERE book_id BETWEEN ? AND ?", (first_id, last_id)
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO book_isbn (book_id, isbn13) "
+        "SELECT book.id, j.value "
+        "FROM book, json_each(isbn13_json(book.isbn, book.isbn_10, book.isbn_13)) j "
+        "WHERE book.id BETWEEN ? AND ?",
+        (first_id, last_id),
+    )
+
+
+def split_names(names):
+    """Return the names of a "; "-joined string (or a list) as a list.
+
+    Google joins its categories with " ;", so split on ";" and strip"""
+    if isinstance(names, list):
+        names = ";".join(names)
+    return [name.strip() for name in (names or "").split(";") if name.strip()]
+
+
+def name_key(name):
+    """Normalize a name for comparison.
+
+    Case, dots and spaces are ignored and 'last, first' is 'first last', so
+    'Shipton, Eric.' -> 'eric shipton'"""
+    key = " ".join(name.replace(".", " ").split()).casefold()
+    if key.count(",") == 1:
+        last, first = key.split(",")
+        key = f"{first.strip()} {last.strip()}".strip()
+    return key
+
+
+def authors_key(authors):
+    """The authors as a sorted tuple of name keys, so the order and the way
+    each name is written don't matter when comparing books"""
+    return tuple(sorted({name_key(name) for name in split_names(authors)}))
+
+
+def sync_book_names(conn, min_id=None, book_ids=None):
+    """Update author/book_author and subject/book_subject from the authors and
+    subjects columns of book. For the books as in `sync_book_isbns`.
+
+    The caller commits"""
+    rows = _book_rows(conn, "id, authors, subjects", min_id, book_ids)
+    ids = [(row[0],) for row in rows]
+    for n, (table, column) in enumerate(NAME_COLUMNS.items(), 1):
+        names = {}
+        links = []
+        for row in rows:
+            for position, name in enumerate(split_names(row[n])):
+                key = name_key(name)
+                names.setdefault(key, name)
+                links.append((row[0], key, position))
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {table} (name, name_key) VALUES(?, ?)",
+            [(name, key) for key, name in names.items()],
+        )
+        name_ids = {
+            key: conn.execute(
+                f"SELECT id FROM {table} WHERE name_key = ?", (key,)
+            ).fetchone()[0]
+            for key in names
+        }
+        conn.executemany(f"DELETE FROM book_{table} WHERE book_id = ?", ids)
+        conn.executemany(
+            f"INSERT OR IGNORE INTO book_{table} (book_id, {table}_id, position) "
+            "VALUES(?, ?, ?)",
+            [(book_id, name_ids[key], pos) for book_id, key, pos in links],
+        )
+
+
+def _books_by(conn, table, name, columns, location):
+    sql = (
+        f"SELECT {columns} FROM book WHERE id IN "
+        f"(SELECT l.book_id FROM book_{table} l JOIN {table} n ON n.id = l.{table}_id "
+        "WHERE n.name_key = ?)"
+    )
+    params = [name_key(name)]
+    if location is not None:
+        sql += " AND location = (SELECT id FROM location WHERE label_name = ?)"
+        params.append(str(location))
+    return conn.execute(sql + " ORDER BY id", params).fetchall()
+
+
+def books_by_author(conn, name, columns="id, title, authors", location=None):
+    """Return the books by the author name, eg. 'Eric Shipton' or
+    'Shipton, Eric'. location is a label_name, eg. '5' or '2.N'"""
+    return _books_by(conn, "author", name, columns, location)
+
+
+def books_by_subject(conn, name, columns="id, title, subjects", location=None):
+    """Return the books with the subject name"""
+    return _books_by(conn, "subject", name, columns, location)
+
+
+def find_books(
+    conn,
+    years=(None, None),
+    pages=(None, None),
+    in_lib=None,
+    location=None,
+    columns="id, title, authors, publish_year, pages",
+):
+    """Return the books published in years (from, to) with pages (min, max).
+
+    None is no limit, eg. years=(1950, 1970), pages=(300, None). in_lib 0/1
+    and location (label_name) are optional"""
+    where, params = [], []
+    for column, (low, high) in (("publish_year", years), ("pages", pages)):
+        if low is not None:
+            where.append(f"{column} >= ?")
+            params.append(low)
+        if high is not None:
+            where.append(f"{column} <= ?")
+            params.append(high)
+    if in_lib is not None:
+        where.append("in_lib = ?")
+        params.append(in_lib)
+    if location is not None:
+        where.append("location = (SELECT id FROM location WHERE label_name = ?)")
+        params.append(str(location))
+    sql = f"SELECT {columns} FROM book"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return conn.execute(sql + " ORDER BY id", params).fetchall()
+
+
+def find_book_by_title_authors(conn, title, authors, columns="id"):
+    """Return the first book with title and the same authors, in any order or
+    spelling of the names, see `authors_key`"""
+    key = authors_key(authors)
+    for row in conn.execute(
+        f"SELECT {columns}, authors FROM book WHERE title = ? ORDER BY id", (title,)
+    ):
+        if authors_key(row[-1]) == key:
+            return row[:-1]
+    return None
+
+
+def find_book_by_isbn(conn, isbn, columns="*"):
+    """Return the first book having isbn(10 or 13) in any of its isbn columns"""
+    isbns = isbn13_list(isbn)
+    if not isbns:
+        return None
+    sql = (
+        f"SELECT {columns} FROM book WHERE id IN "
+        "(SELECT book_id FROM book_isbn WHERE isbn13 = ?) ORDER BY id"
+    )
+    return conn.execute(sql, (isbns[0],)).fetchone()
+
+
+class BookKeys:
+    """The isbns and (title, authors) of all books in the DB, held in memory.
+
+    Loaded once with two queries, so checking if a book exists during an import
+    is a set lookup instead of a SELECT per book. Add the books as they are
+    written. Use `find_book_by_isbn`/`find_book_by_title_authors` for ad-hoc
+    checks.
+
+    keys = BookKeys(conn)
+    if not keys.exist(isbn=isbn, title=title, authors=authors):
+        ...
+        keys.add(sanitize_metadata(data))
+    """
+
+    def __init__(self, conn):
+        # every isbn of a book, as isbn13. See book_isbn
+        self.isbns = {row[0] for row in conn.execute("SELECT isbn13 FROM book_isbn")}
+        # (title, authors_key), so the order of the authors doesn't matter
+        self.titles = {
+            (title, authors_key(authors))
+            for title, authors in conn.execute("SELECT title, authors FROM book")
+        }
+        LOGGER.debug(
+            "loaded %s isbns and %s titles", len(self.isbns), len(self.titles)
+        )
+
+    def exist(self, isbn="", title="", authors=""):
+        """Check for the isbn if given, otherwise the title and authors.
+
+        Like `find_book_by_isbn` or `find_book_by_title_authors`"""
+        isbns = isbn13_list(isbn)
+        if isbns:
+            return isbns[0] in self.isbns
+        return (title, authors_key(authors)) in self.titles
+
+    def add(self, data):
+        # data is a tuple from sanitize_metadata
+        self.isbns.update(isbn13_list(*data[0:3]))
+        self.titles.add((data[7], authors_key(data[8])))
+
+
+class IsbnIndex:
+    """isbn13 -> book for all books in the DB, held in memory.
+
+    For the barcode scanner, where a scan should be shown at once however
+    large the catalogue is. Every isbn in the "; "-joined isbn columns is
+    indexed as isbn13, so a scan of either the isbn10 or isbn13 finds the book.
+    The books are kept as rows of columns (id first); update the index when a
+    book is changed.
+
+    index = IsbnIndex(conn, "id, title, location")
+    book_id, title, location = index.find("0898860075")
+    index.update(book_id, "location", 3)
+    """
+
+    def __init__(self, conn, columns="id, title, authors"):
+        self.columns = [col.strip() for col in columns.split(",")]
+        # id -> list of the columns
+        self.books = {}
+        # isbn13 -> id. The lowest id if more books have the same isbn, like
+        # find_book_by_isbn
+        self.ids = {}
+        self.load(conn)
+        LOGGER.debug("indexed %s isbns of %s books", len(self.ids), len(self.books))
+
+    def load(self, conn, book_ids=None):
+        """Add all books, or the books in book_ids, from the DB"""
+        sql = f"SELECT {', '.join(self.columns)}, isbn, isbn_10, isbn_13 FROM book"
+        if book_ids is None:
+            rows = conn.execute(sql + " ORDER BY id")
+        else:
+            rows = [
+                row
+                for book_id in book_ids
+                for row in conn.execute(sql + " WHERE id = ?", (book_id,))
+            ]
+        for row in rows:
+            self.add(row[:-3], row[-3:])
+
+    def add(self, row, isbns):
+        self.books[row[0]] = list(row)
+        for isbn13 in isbn13_list(*isbns):
+            self.ids.setdefault(isbn13, row[0])
+
+    def find(self, isbn):
+        """Return the book with isbn(10 or 13) as a tuple of the columns"""
+        # a scanned EAN-13 is already the key
+        book_id = self.ids.get(isbn)
+        if book_id is None:
+            isbns = isbn13_list(isbn)
+            book_id = self.ids.get(isbns[0]) if isbns else None
+        if book_id is None:
+            return None
+        return tuple(self.books[book_id])
+
+    def update(self, book_id, column, value):
+        # keep the index in sync after "UPDATE book SET column = value"
+        if column in self.columns and book_id in self.books:
+            self.books[book_id][self.columns.index(column)] = value
+
+    def __len__(self):
+        return len(self.ids)
+
+
 def insert_book(conn, data):
     # insert a new book, after checking if it exist
 
-    d = {"title": data[7], "authors": data[8]}
-    if book_exist(conn, d):
+    if find_book_by_title_authors(conn, data[7], data[8]):
         return
 
-    # do this a bit more dynamically
-    # https://stackoverflow.com/a/39361069
-    sql = """INSERT INTO book
-    (isbn, isbn_10, isbn_13, olid, goodreads, lccn, oclc, title, authors,
-    publisher, publish_date, number_of_pages, subjects,
-    openlibrary_medcover_url, location, language, openlibrary_preview_url,
-    description)
-    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) """
-    return updatedb(conn, sql, data)
+    sql = INSERT_SQL.format(conflict="")
+    book_id = updatedb(conn, sql, data)
+    sync_book_isbns(conn, book_ids=[book_id])
+    sync_book_names(conn, book_ids=[book_id])
+    sync_book_trigrams(conn, book_ids=[book_id])
+    conn.commit()
+    return book_id
+
+
+class BookWriter:
+    """Insert books in batches, one transaction per batch.
+
+    The books are tuples from `sanitize_metadata`. Books already in the DB are
+    skipped by the unique indexes, instead of a SELECT before every insert.
+    Optionally a row from the mdb import is marked in the import journal in the
+    same transaction, so the journal never says done for an unwritten book.
+
+    with BookWriter(conn) as writer:
+        for data in books:
+            writer.add(data)
+    """
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.books = []
+        self.journal = []
+        # number of books inserted/skipped as duplicates
+        self.inserted = 0
+        self.skipped = 0
+        upgrade_schema(conn)
+
+    def add(self, data, row_key=None, status=JOURNAL_DONE):
+        self.books.append(data)
+        if row_key is not None:
+            self.journal.append((row_key, status, ""))
+        if len(self.books) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.books and not self.journal:
+            return
+        max_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM book").fetchone()[0]
+        # the connection as a context manager commits, or rolls back on error
+        with self.conn:
+            self.conn.executemany(INSERT_SQL.format(conflict="OR IGNORE"), self.books)
+            # only the book rows. total_changes also counts the writes of the
+            # search index triggers
+            inserted = self.conn.execute(
+                "SELECT count(*) FROM book WHERE id > ?", (max_id,)
+            ).fetchone()[0]
+            sync_book_isbns(self.conn, min_id=max_id)
+            sync_book_names(self.conn, min_id=max_id)
+            sync_book_trigrams(self.conn, min_id=max_id)
+            if self.journal:
+                self.conn.executemany(JOURNAL_MARK_SQL, self.journal)
+        LOGGER.debug("wrote %s of %s books", inserted, len(self.books))
+        self.inserted += inserted
+        self.skipped += len(self.books) - inserted
+        self.books = []
+        self.journal = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 
 def update_book(conn, data):
@@ -149,9 +1211,11 @@ def sanitize_metadata(data):
         d["subjects"] = data["categories"]
         d["openlibrary_medcover_url"] = data["thumbnail"]
         d["location"] = data["location"]
-        d["langauge"] = data["language"]
+        d["language"] = data["language"]
         d["openlibrary_preview_url"] = data["preview_url"]
         d["description"] = data["description"]
+        d["publish_year"] = parse_year(data["year"])
+        d["pages"] = parse_pages(data["pages"])
     except KeyError as e:
         LOGGER.debug("RecordMappingError for %s with data %s", e, data)
         raise RecordMappingError(e)
@@ -171,11 +1235,66 @@ if __name__ == "__main__":
         action="store_true",  # set to True if present
         help="Fill the locations table. Only to be run on new DBs",
     )
+    parser.add_argument(
+        "-u",
+        "--upgrade",
+        action="store_true",
+        help="Add indexes, the book_isbn table and the search index to an existing DB",
+    )
+    parser.add_argument(
+        "--compact-scans",
+        action="store_true",
+        help="Keep only the last scan of each unknown isbn in scan_event",
+    )
+    parser.add_argument("-s", "--search", help="search title, authors, subjects, ..")
+    parser.add_argument(
+        "--years", help="books published in these years, eg. 1950-1970 or 1950-"
+    )
+    parser.add_argument("--pages", help="books with these pages, eg. 300-")
+    parser.add_argument("-a", "--author", help="books by this author")
+    parser.add_argument("--subject", help="books with this subject")
+    parser.add_argument("-n", "--limit", type=int, default=SEARCH_LIMIT)
+    parser.add_argument("-l", "--location", help="only this location, eg. 5 or 2.N")
+    parser.add_argument(
+        "--raw", action="store_true", help="the search is FTS5 query syntax"
+    )
     args = parser.parse_args()
 
     # create locations. Only to be run once
     if args.init:
         r = create_locations(conn)
+    if args.upgrade:
+        upgrade_schema(conn)
+        print(f"schema version {schema_version(conn)}")
+    if args.compact_scans:
+        n = compact_scan_events(conn)
+        print(f"removed {n} scans")
+    if args.years or args.pages:
+        upgrade_schema(conn)
+
+        def _range(s):
+            low, _, high = (s or "-").partition("-")
+            return (int(low) if low else None, int(high) if high else None)
+
+        for book in find_books(
+            conn, _range(args.years), _range(args.pages), location=args.location
+        ):
+            print("{:>5} {} - {}, {}, {} pages".format(*book))
+    if args.author or args.subject:
+        upgrade_schema(conn)
+        if args.author:
+            books = books_by_author(conn, args.author, location=args.location)
+        else:
+            books = books_by_subject(
+                conn, args.subject, "id, title, authors", location=args.location
+            )
+        for book_id, title, authors in books:
+            print(f"{book_id:>5} {title} - {authors}")
+    if args.search:
+        upgrade_schema(conn)
+        for hit in search(conn, args.search, args.limit, args.location, args.raw):
+            print(f"{hit.id:>5} [{hit.location}] {hit.title} - {hit.authors}")
+            print(f"      {hit.snippet}")
 
 
 # id_loc_map = get_locations_id(conn)
@@ -13,83 +13,104 @@ If isbn_10 is missing and isbn is present, copy from isbn. If isbn_13 is missing
 and isbn_10 present, calculate isbn_13. isbn will always be the original from
 the .mdb DB.
 
+The isbn functions are registered on the sqlite connection, so each backfill is
+an `UPDATE ... WHERE` run by sqlite, in transactions of CHUNK_SIZE books.
+Invalid isbns are recorded in the `invalid_isbn` table.
+
 """
 
 import argparse
 import logging
 
-from isbnlib import notisbn, to_isbn13
-
-from bookdb import create_connection
+from bookdb import (
+    create_connection,
+    register_isbn_functions,
+    sync_book_isbn_range,
+    upgrade_schema,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 # set the root logger to debug. All other loggers ends here, due to chaining
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
+LOGGER = logging.getLogger(__name__)
 
 
 BOOKS_DB = "books.sqlite"
+# books updated per transaction, by id range
+CHUNK_SIZE = 5000
 conn = create_connection(BOOKS_DB)
-
-
-def set_isbn10():
+upgrade_schema(conn)
+# the isbnlib functions are run by sqlite, in the UPDATE statements
+register_isbn_functions(conn)
+
+# isbns that are not valid, found by the backfill
+INVALID_SQL = """CREATE TABLE IF NOT EXISTS invalid_isbn (
+        book_id INTEGER NOT NULL,
+        field VARCHAR(20) NOT NULL,
+        isbn VARCHAR(20) NOT NULL,
+        found TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (book_id, field, isbn),
+        FOREIGN KEY(book_id) REFERENCES book (id)
+)"""
+
+ISBN10_INVALID_SQL = """INSERT OR REPLACE INTO invalid_isbn (book_id, field, isbn)
+    SELECT id, 'isbn', isbn FROM book
+    WHERE isbn_10 = '' AND isbn != '' AND NOT valid_isbn(isbn)
+    AND id BETWEEN ? AND ?"""
+ISBN10_SQL = """UPDATE book SET isbn_10 = isbn
+    WHERE isbn_10 = '' AND isbn != '' AND valid_isbn(isbn)
+    AND id BETWEEN ? AND ?"""
+
+ISBN13_INVALID_SQL = """INSERT OR REPLACE INTO invalid_isbn (book_id, field, isbn)
+    SELECT book.id, 'isbn_10', j.value FROM book, json_each(invalid_isbns_json(isbn_10)) j
+    WHERE isbn_13 = '' AND isbn_10 != ''
+    AND book.id BETWEEN ? AND ?"""
+ISBN13_SQL = """UPDATE book SET isbn_13 = to_isbn13s(isbn_10)
+    WHERE isbn_13 = '' AND isbn_10 != ''
+    AND id BETWEEN ? AND ?"""
+
+
+def backfill(invalid_sql, update_sql, chunk_size=CHUNK_SIZE):
+    """Run invalid_sql and update_sql on the books, chunk_size ids at a time.
+
+    Each chunk is one transaction, which also updates book_isbn, so memory use
+    doesn't grow with the DB and an interrupted backfill keeps the finished
+    chunks. Returns the number of books updated"""
+    conn.execute(INVALID_SQL)
+    first, last = conn.execute("SELECT min(id), max(id) FROM book").fetchone()
+    if first is None:
+        return 0
+    updated = 0
+    for start in range(first, last + 1, chunk_size):
+        end = start + chunk_size - 1
+        with conn:
+            conn.execute(invalid_sql, (start, end))
+            cur = conn.execute(update_sql, (start, end))
+            if cur.rowcount:
+                sync_book_isbn_range(conn, start, end)
+        updated += cur.rowcount
+    n = conn.execute("SELECT count(*) FROM invalid_isbn").fetchone()[0]
+    LOGGER.info("updated %s books. %s invalid isbns in invalid_isbn", updated, n)
+    return updated
+
+
+def set_isbn10(chunk_size=CHUNK_SIZE):
     """if isbn10 is empty, copy from from isbn"""
-    sql = "select id, isbn from book where isbn_10 = ? and isbn != ?;"
-    key = ("", "")
-    cur = conn.cursor()
-    cur.execute(sql, key)
-    res = cur.fetchall()
-
-    data = []
-    for book in res:
-        id, isbn = book
-        if notisbn(isbn):
-            print(f"error, id {id}, isbn {isbn} is not a valid isbn")
-            continue
-        isbn_10 = isbn
+    return backfill(ISBN10_INVALID_SQL, ISBN10_SQL, chunk_size)
 
-        data.append((isbn_10, id))
 
-    sql = "UPDATE book SET isbn_10 = ? WHERE id = ?;"
-    cur.executemany(sql, data)
-    conn.commit()
-
-
-def set_isbn13():
+def set_isbn13(chunk_size=CHUNK_SIZE):
     """If isbn13 is empty, calculate it from isbn10
 
     Remember there can be multiple isbns in the isbn_10 field, due to errors in
     the openlibrary.org db. Thus we must split on ';' and calculate isbn13 for
     all of the them"""
-
-    sql = "select id, isbn_10 from book where isbn_13 = ? and isbn_10 != ?;"
-    key = ("", "")
-    cur = conn.cursor()
-    cur.execute(sql, key)
-    res = cur.fetchall()
-
-    data = []
-    for book in res:
-        id, isbns = book
-        isbns = isbns.split("; ")
-        isbn_13 = []
-        for isbn_10 in isbns:
-            if notisbn(isbn_10):
-                print(f"error, id {id}, isbn_10 {isbn_10} is not a valid isbn")
-                continue
-            isbn_13.append(to_isbn13(isbn_10))
-        data.append(("; ".join(isbn_13), id))
-
-    sql = "UPDATE book SET isbn_13 = ? WHERE id = ?;"
-    cur.executemany(sql, data)
-    conn.commit()
+    return backfill(ISBN13_INVALID_SQL, ISBN13_SQL, chunk_size)
 
 
 def main():
-    # If no arg is given, run the default which is to show the usage
-    # https://stackoverflow.com/a/40613995
     parser = argparse.ArgumentParser()
-    parser.set_defaults(func=lambda x: parser.print_usage())
     parser.add_argument(
         # https://docs.python.org/3/library/argparse.html#action
         "--isbn10",
@@ -97,15 +118,17 @@ def main():
         action="store_true",  # set to True if present
     )
     parser.add_argument("--isbn13", required=False, action="store_true")
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE, help="books per transaction"
+    )
     args = parser.parse_args()
-    args.func(args)
-    try:
-        if args.isbn10:
-            set_isbn10()
-        if args.isbn13:
-            set_isbn13()
-    except:
-        pass
+    # If no arg is given, show the usage
+    if not (args.isbn10 or args.isbn13):
+        parser.print_usage()
+    if args.isbn10:
+        set_isbn10(args.chunk_size)
+    if args.isbn13:
+        set_isbn13(args.chunk_size)
 
 
 if __name__ == "__main__":
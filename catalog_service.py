@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+
+"""Read-only HTTP/JSON service for the catalogue in books.sqlite.
+
+Endpoints (GET only)
+
+    /isbn/<isbn>                      the book with this isbn10/13
+    /books/<id>                       a book by id
+    /search?q=k2+savage&location=2.12 full-text search, see `bookdb.search`
+    /locations                        all locations with the number of books
+    /locations/<label>/books          the books at a location, eg. /locations/5/books
+    /covers/<sha256>/<small|medium>   a cover downloaded by covers.py, as JPEG
+    /stats                            requests, cache hits and pool size
+
+Lists return `{"items": [...], "next": cursor}`. Pass `?cursor=<next>` for the
+next page, `next` is null on the last page. The cursor holds the position of
+the last item (id, or score and id for searches), so a page is an index seek,
+however far into the list it is. `limit` sets the page size.
+
+The server is a single asyncio loop with a minimal HTTP/1.1 parser (keep-alive,
+no request bodies). The sqlite queries run in a small thread pool, each thread
+with its own read-only connection, so a slow query doesn't block the loop.
+Lookups by isbn are kept in an in-memory LRU cache and answered without leaving
+the loop.
+
+If the covers are downloaded (covers.py), books have the urls of their local
+covers, eg. `"cover": {"small": "/covers/3f2a.../small", ...}`. The covers are
+content addressed, so they are served as immutable and cached by browsers.
+They are read from the --covers directory given to covers.py.
+
+python catalog_service.py --db books.sqlite --port 8000 --covers covers
+curl localhost:8000/isbn/0898860075
+
+Load test with bench/load_catalog.py
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import queue
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from bookdb import find_book_by_isbn, get_locations_id, isbn13_list, search
+
+LOGGER = logging.getLogger(__name__)
+
+DB_FILE = "books.sqlite"
+PORT = 8000
+POOL_SIZE = 4
+CACHE_SIZE = 4096
+# seconds a cached isbn lookup is served, before it is read again
+CACHE_TTL = 60
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# largest request head (request line and headers) we accept
+MAX_HEAD = 16 * 1024
+
+BOOK_COLUMNS = (
+    "id, title, authors, isbn, isbn_10, isbn_13, olid, publisher, publish_date, "
+    "number_of_pages, language, subjects, description, location, "
+    "openlibrary_medcover_url, openlibrary_preview_url"
+)
+LIST_COLUMNS = "id, title, authors, publish_date, location"
+# the sha256 of the downloaded cover of a book, see covers.py
+COVER_COLUMN = (
+    "(SELECT c.sha256 FROM book_cover c "
+    "WHERE c.book_id = book.id AND c.status = 'ok') AS cover"
+)
+# the variants of a cover, and the directory they are stored in, see covers.py
+COVER_VARIANTS = ("small", "medium")
+COVERS_DIR = "covers"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class LRUCache:
+    """A dict with at most maxsize entries, each kept for ttl seconds.
+
+    Only used from the event loop, so it needs no lock."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or time.monotonic() - item[1] > self.ttl:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ReadPool:
+    """Read-only sqlite connections, one per thread of the pool.
+
+    rows = await pool.run(func, *args)  # func(conn, *args) in a pool thread"""
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.size = size
+        self._conns = queue.Queue()
+        for _ in range(size):
+            # mode=ro: the service can never write to the catalogue
+            conn = sqlite3.connect(
+                f"file:{db_file}?mode=ro", uri=True, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            self._conns.put(conn)
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="sqlite")
+
+    def _call(self, func, args):
+        conn = self._conns.get()
+        try:
+            return func(conn, *args)
+        finally:
+            self._conns.put(conn)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._conns.empty():
+            self._conns.get().close()
+
+
+def encode_cursor(*values):
+    data = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    # the size numbers encoded by encode_cursor
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except ValueError:
+        raise HTTPError(400, "invalid cursor")
+    if not (
+        isinstance(values, list)
+        and len(values) == size
+        and all(type(v) in (int, float) for v in values)
+    ):
+        raise HTTPError(400, "invalid cursor")
+    return values
+
+
+def _int(params, name, default, maximum=None):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer")
+    if value < 1:
+        raise HTTPError(400, f"{name} must be positive")
+    return min(value, maximum) if maximum else value
+
+
+# the queries, run in the pool threads
+
+
+def _book_by_id(conn, book_id, columns=BOOK_COLUMNS):
+    sql = f"SELECT {columns} FROM book WHERE id = ?"
+    return conn.execute(sql, (book_id,)).fetchone()
+
+
+def _books_at(conn, loc_id, after, limit, columns=LIST_COLUMNS):
+    sql = (
+        f"SELECT {columns} FROM book WHERE location = ? AND id > ? "
+        "ORDER BY id LIMIT ?"
+    )
+    return conn.execute(sql, (loc_id, after, limit)).fetchall()
+
+
+def _has_covers(conn):
+    sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_cover'"
+    return conn.execute(sql).fetchone() is not None
+
+
+def _read_cover(conn, covers_dir, sha256, variant):
+    # the JPEG of a cover variant, or None. variant must be in COVER_VARIANTS.
+    # The paths are relative to covers_dir
+    sql = f"SELECT {variant}_path FROM cover WHERE sha256 = ?"
+    row = conn.execute(sql, (sha256,)).fetchone()
+    if not row or not row[0]:
+        return None
+    try:
+        with open(os.path.join(covers_dir, row[0]), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _location_counts(conn):
+    sql = "SELECT location, count(*) FROM book GROUP BY location"
+    return dict(conn.execute(sql).fetchall())
+
+
+class Catalog:
+    """The request handlers. handle(path) returns (status, data)"""
+
+    def __init__(
+        self,
+        pool,
+        locations,
+        cache_size=CACHE_SIZE,
+        cache_ttl=CACHE_TTL,
+        covers_dir=None,
+    ):
+        self.pool = pool
+        # the covers are only looked up, if the DB has the cover tables
+        self.covers_dir = covers_dir
+        self.book_columns = BOOK_COLUMNS
+        self.list_columns = LIST_COLUMNS
+        if covers_dir:
+            self.book_columns += f", {COVER_COLUMN}"
+            self.list_columns += f", {COVER_COLUMN}"
+        # {id: (label_name, full_name)}, see get_locations_id
+        self.locations = locations
+        self.loc_ids = {label: loc_id for loc_id, (label, _) in locations.items()}
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.requests = 0
+        self.started = time.time()
+
+    def book(self, row):
+        book = dict(row)
+        if "location" in book:
+            label, name = self.locations.get(book["location"], (None, None))
+            book["location"] = {"id": book["location"], "label": label, "name": name}
+        if "cover" in book:
+            sha256 = book["cover"]
+            book["cover"] = sha256 and {
+                variant: f"/covers/{sha256}/{variant}" for variant in COVER_VARIANTS
+            }
+        return book
+
+    async def handle(self, path):
+        self.requests += 1
+        url = urlsplit(path)
+        parts = [unquote(p) for p in url.path.strip("/").split("/")]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if len(parts) == 2 and parts[0] == "isbn":
+            return await self.get_isbn(parts[1])
+        if len(parts) == 2 and parts[0] == "books":
+            return await self.get_book(parts[1])
+        if parts == ["search"]:
+            return await self.search(params)
+        if parts == ["locations"]:
+            return await self.get_locations()
+        if len(parts) == 3 and parts[0] == "locations" and parts[2] == "books":
+            return await self.location_books(parts[1], params)
+        if len(parts) == 3 and parts[0] == "covers":
+            return await self.get_cover(parts[1], parts[2])
+        if parts == ["stats"]:
+            return 200, self.stats()
+        raise HTTPError(404, f"no such endpoint {url.path}")
+
+    async def get_isbn(self, isbn):
+        isbns = isbn13_list(isbn)
+        if not isbns:
+            raise HTTPError(400, f"invalid isbn {isbn}")
+        key = isbns[0]
+        # unknown isbns are cached too, as False
+        book = self.cache.get(key)
+        if book is None:
+            row = await self.pool.run(find_book_by_isbn, key, self.book_columns)
+            book = self.book(row) if row else False
+            self.cache.put(key, book)
+        if not book:
+            raise HTTPError(404, f"no book with isbn {isbn}")
+        return 200, book
+
+    async def get_book(self, book_id):
+        if not book_id.isdigit():
+            raise HTTPError(400, "the book id must be an integer")
+        row = await self.pool.run(_book_by_id, int(book_id), self.book_columns)
+        if not row:
+            raise HTTPError(404, f"no book with id {book_id}")
+        return 200, self.book(row)
+
+    async def search(self, params):
+        query = params.get("q", "")
+        if not query.strip():
+            raise HTTPError(400, "missing q")
+        limit = _int(params, "limit", PAGE_SIZE, MAX_PAGE_SIZE)
+        after = decode_cursor(params["cursor"], 2) if "cursor" in params else None
+        try:
+            # one more than limit, to know if there is a next page
+            hits = await self.pool.run(
+                search, query, limit + 1, params.get("location"), False, after
+            )
+        except sqlite3.OperationalError as e:
+            LOGGER.error("search failed: %s", e)
+            raise HTTPError(503, "no search index, run: python bookdb.py --upgrade")
+        items = [hit._asdict() for hit in hits[:limit]]
+        cursor = None
+        if len(hits) > limit:
+            cursor = encode_cursor(hits[limit - 1].score, hits[limit - 1].id)
+        return 200, {"items": items, "next": cursor}
+
+    async def get_cover(self, sha256, variant):
+        if not self.covers_dir or variant not in COVER_VARIANTS:
+            raise HTTPError(404, f"no cover {sha256}/{variant}")
+        data = await self.pool.run(_read_cover, self.covers_dir, sha256, variant)
+        if data is None:
+            raise HTTPError(404, f"no cover {sha256}/{variant}")
+        return 200, data
+
+    async def get_locations(self):
+        counts = await self.pool.run(_location_counts)
+        items = [
+            {"id": loc_id, "label": label, "name": name, "books": counts.get(loc_id, 0)}
+            for loc_id, (label, name) in sorted(self.locations.items())
+        ]
+        return 200, {"items": items, "next": None}
+
+    async def location_books(self, label, params):
+        loc_id = self.loc_ids.get(label)
+        if loc_id is None:
+            raise HTTPError(404, f"no location {label}")
+        limit = _int(params, "limit", PAGE_SIZE, MAX_PAGE_SIZE)
+        after = decode_cursor(params["cursor"], 1)[0] if "cursor" in params else 0
+        rows = await self.pool.run(
+            _books_at, loc_id, after, limit + 1, self.list_columns
+        )
+        items = [self.book(row) for row in rows[:limit]]
+        cursor = encode_cursor(rows[limit - 1]["id"]) if len(rows) > limit else None
+        return 200, {"items": items, "next": cursor}
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            "requests": self.requests,
+            "uptime": round(elapsed, 1),
+            "cache": {
+                "size": len(self.cache),
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+            },
+            "pool_size": self.pool.size,
+        }
+
+
+def response(status, data, keep_alive=True):
+    # data is json, or the bytes of a cover. A cover never changes, as its
+    # path is the hash of its content
+    if isinstance(data, bytes):
+        body = data
+        headers = (
+            "Content-Type: image/jpeg\r\n"
+            "Cache-Control: max-age=31536000, immutable\r\n"
+        )
+    else:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        headers = "Content-Type: application/json; charset=utf-8\r\n"
+    head = (
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"{headers}"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode() + body
+
+
+async def read_request(reader):
+    """Return (method, path, version, headers) or None if the client is gone"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(400, "request head too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, version = lines[0].split(" ")
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    # we take no bodies, but must not read a body as the next request
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "invalid content-length")
+    if length < 0:
+        raise HTTPError(400, "invalid content-length")
+    if length:
+        await reader.readexactly(length)
+    return method, path, version, headers
+
+
+def make_handler(catalog):
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    writer.write(response(e.status, {"error": e.message}, False))
+                    break
+                if request is None:
+                    break
+                method, path, version, headers = request
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" and (
+                    version == "HTTP/1.1" or connection == "keep-alive"
+                )
+                if method != "GET":
+                    status, data = 405, {"error": "only GET is supported"}
+                else:
+                    try:
+                        status, data = await catalog.handle(path)
+                    except HTTPError as e:
+                        status, data = e.status, {"error": e.message}
+                    except Exception:
+                        LOGGER.exception("error in %s", path)
+                        status, data = 500, {"error": "internal error"}
+                writer.write(response(status, data, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+async def serve(
+    db_file=DB_FILE,
+    host="127.0.0.1",
+    port=PORT,
+    pool_size=POOL_SIZE,
+    cache_size=CACHE_SIZE,
+    cache_ttl=CACHE_TTL,
+    started=None,
+    covers_dir=COVERS_DIR,
+):
+    pool = ReadPool(db_file, pool_size)
+    locations = await pool.run(get_locations_id)
+    if not await pool.run(_has_covers):
+        covers_dir = None
+    catalog = Catalog(pool, locations, cache_size, cache_ttl, covers_dir)
+    server = await asyncio.start_server(
+        make_handler(catalog), host, port, limit=MAX_HEAD, backlog=1024
+    )
+    LOGGER.info("serving %s on %s", db_file, server.sockets[0].getsockname())
+    if started is not None:
+        started(server)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=PORT)
+    parser.add_argument(
+        "--pool-size", type=int, default=POOL_SIZE, help="read-only sqlite connections"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=CACHE_SIZE, help="isbn lookups kept in memory"
+    )
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="seconds")
+    parser.add_argument(
+        "--covers", default=COVERS_DIR, help="the covers downloaded by covers.py"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(
+            serve(
+                args.db,
+                args.host,
+                args.port,
+                args.pool_size,
+                args.cache_size,
+                args.cache_ttl,
+                covers_dir=args.covers,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""Download the covers of the books, so they can be shown without asking
+openlibrary or google for every page.
+
+The cover urls (openlibrary_medcover_url, which is the google thumbnail if
+openlibrary has no cover) are downloaded by a few worker threads, and each
+image is stored once by the sha256 of its content
+
+    covers/3f/3f2a...        the image as downloaded
+    covers/3f/3f2a...-small.jpg
+    covers/3f/3f2a...-medium.jpg
+
+The small and medium variants are resized in a process pool, as resizing is
+cpu bound. The paths, relative to the covers directory, are recorded in the
+`cover` and `book_cover` tables, see `bookdb.COVER_SQL`. The download, resize
+and write stages run as a `pipeline`, so the number of downloads and resizes at
+a time is bounded.
+
+A book whose cover url was downloaded before is skipped, so a rerun only
+fetches the new and changed urls, and the ones that failed. Books sharing a url
+are downloaded once, and the same image from different urls is stored once.
+
+python covers.py --workers 8
+python covers.py --retry-missing
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image
+
+from bookdb import create_connection, upgrade_schema
+from helpers import wfetch
+from metrics import METRICS
+import pipeline
+
+LOGGER = logging.getLogger(__name__)
+
+BOOKS_DB = "books.sqlite"
+COVERS_DIR = "covers"
+WORKERS = 8
+PROCESSES = os.cpu_count() or 2
+# bounding boxes (width, height) of the variants
+SIZES = {"small": (80, 120), "medium": (200, 300)}
+JPEG_QUALITY = 85
+# book_cover rows written per transaction
+WRITE_BATCH = 50
+
+# status of a book_cover
+OK = "ok"
+MISSING = "missing"
+FAILED = "failed"
+
+# the cover urls not downloaded yet, with the books using them. known is the
+# sha256 of a cover already downloaded from the url for another book
+JOBS_SQL = """SELECT b.openlibrary_medcover_url, group_concat(b.id),
+        (SELECT k.sha256 FROM book_cover k
+         WHERE k.url = b.openlibrary_medcover_url AND k.status = 'ok' LIMIT 1)
+    FROM book b LEFT JOIN book_cover c ON c.book_id = b.id
+    WHERE coalesce(b.openlibrary_medcover_url, '') != ''
+        AND (c.book_id IS NULL OR c.url IS NOT b.openlibrary_medcover_url
+             OR c.status NOT IN ({done}))
+    GROUP BY b.openlibrary_medcover_url"""
+
+
+def cover_path(covers_dir, sha256, variant=None):
+    """The path of the cover with sha256, or of its variant, eg. 'small'"""
+    name = f"{sha256}-{variant}.jpg" if variant else sha256
+    return os.path.join(covers_dir, sha256[:2], name)
+
+
+def _write(path, data):
+    # write to a temporary file first, so a path that exists is complete
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def make_variants(path, sizes=SIZES, quality=JPEG_QUALITY):
+    """Save the resized variants of the image at path as JPEGs next to it.
+
+    Runs in a worker process. Returns (width, height, {variant: path})"""
+
+    paths = {}
+    with Image.open(path) as image:
+        width, height = image.size
+        image = image.convert("RGB")
+        for variant, box in sizes.items():
+            resized = image.copy()
+            # keeps the aspect ratio, and never enlarges the image
+            resized.thumbnail(box)
+            variant_path = f"{path}-{variant}.jpg"
+            tmp = f"{variant_path}.{os.getpid()}.tmp"
+            resized.save(tmp, "JPEG", quality=quality)
+            os.replace(tmp, variant_path)
+            paths[variant] = variant_path
+    return width, height, paths
+
+
+def get_jobs(conn, retry_missing=False):
+    """Return a job per cover url to download, see JOBS_SQL"""
+    done = "'ok'" if retry_missing else "'ok', 'missing'"
+    return [
+        {"url": url, "book_ids": [int(i) for i in ids.split(",")], "sha256": known}
+        for url, ids, known in conn.execute(JOBS_SQL.format(done=done))
+    ]
+
+
+def fetch(job, covers_dir):
+    """Stage 1: download the cover and store it by its sha256"""
+    if job["sha256"]:
+        # the url was downloaded for another book
+        return job
+    with METRICS.time("cover_fetch"):
+        data = wfetch(job["url"])
+    if data is None:
+        job["status"] = MISSING
+        return job
+    job["sha256"] = hashlib.sha256(data).hexdigest()
+    job["size"] = len(data)
+    path = cover_path(covers_dir, job["sha256"])
+    if os.path.exists(path):
+        METRICS.count("covers", result="duplicate")
+    else:
+        _write(path, data)
+    return job
+
+
+def resize(job, covers_dir, executor):
+    """Stage 2: make the variants in the process pool, if they are missing"""
+    if job.get("status") == MISSING:
+        return job
+    path = cover_path(covers_dir, job["sha256"])
+    if all(os.path.exists(cover_path(covers_dir, job["sha256"], v)) for v in SIZES):
+        return job
+    with METRICS.time("cover_resize"):
+        width, height, _ = executor.submit(make_variants, path).result()
+    job["width"], job["height"] = width, height
+    return job
+
+
+def write(jobs, conn, covers_dir):
+    """Stage 3: record the covers and the books using them, a batch of jobs in
+    one transaction"""
+    now = time.time()
+    with conn:
+        for job in jobs:
+            status = job.get("status", OK)
+            sha256 = job["sha256"] if status == OK else None
+            if sha256:
+                # relative to covers_dir, so the covers can be served from
+                # anywhere, see catalog_service --covers
+                paths = [cover_path("", sha256, v) for v in (None, *SIZES)]
+                conn.execute(
+                    "INSERT OR IGNORE INTO cover "
+                    "(sha256, path, small_path, medium_path, width, height, size) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        sha256,
+                        *paths,
+                        job.get("width"),
+                        job.get("height"),
+                        job.get("size"),
+                    ),
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO book_cover "
+                "(book_id, url, sha256, status, error, fetched) "
+                "VALUES(?, ?, ?, ?, NULL, ?)",
+                [
+                    (book_id, job["url"], sha256, status, now)
+                    for book_id in job["book_ids"]
+                ],
+            )
+            METRICS.count("covers", result=status)
+    return jobs
+
+
+def run(
+    db_file=BOOKS_DB,
+    covers_dir=COVERS_DIR,
+    workers=WORKERS,
+    processes=PROCESSES,
+    retry_missing=False,
+):
+    """Download the covers not downloaded yet. Returns the pipeline stats"""
+    conn = create_connection(db_file, check_same_thread=False)
+    upgrade_schema(conn)
+    jobs = get_jobs(conn, retry_missing)
+    LOGGER.info("%s cover urls to download", len(jobs))
+
+    # on_error is called from the stage threads, so the failures are written
+    # at the end, instead of sharing conn with the write stage
+    failed = []
+
+    def on_error(item, e):
+        # a failed download is tried again on the next run
+        failed.extend(
+            (book_id, item["url"], FAILED, repr(e), time.time())
+            for book_id in item["book_ids"]
+        )
+        METRICS.count("covers", result=FAILED)
+
+    with ProcessPoolExecutor(processes) as executor:
+        stages = [
+            (partial(fetch, covers_dir=covers_dir), workers),
+            (partial(resize, covers_dir=covers_dir, executor=executor), processes),
+            (partial(write, conn=conn, covers_dir=covers_dir), 1, WRITE_BATCH),
+        ]
+        stats = pipeline.run(jobs, stages, on_error=on_error)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO book_cover "
+            "(book_id, url, sha256, status, error, fetched) "
+            "VALUES(?, ?, NULL, ?, ?, ?)",
+            failed,
+        )
+    conn.close()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=BOOKS_DB)
+    parser.add_argument("--covers", default=COVERS_DIR, help="store the covers here")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS)
+    parser.add_argument(
+        "-p", "--processes", type=int, default=PROCESSES, help="for the resizing"
+    )
+    parser.add_argument(
+        "--retry-missing",
+        action="store_true",
+        help="also try the urls that were not found (404) before",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    stats = run(args.db, args.covers, args.workers, args.processes, args.retry_missing)
+    print(stats)
+    print(METRICS.summary()["counters"].get("covers", {}))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from _exceptions import RecordMappingError
 from numpy import NaN
 from isbnlib import canonical as isbn_canonical, is_isbn10, is_isbn13
 import logging
+import pandas as pd
 
 LOGGER = logging.getLogger(__name__)
 
@@ -125,3 +126,93 @@ def query(records):
     except Exception:  # pragma: no cover
         raise RecordMappingError(f"for ({isbn}, {title}) with data {records}")
     return canonical
+
+
+def _column(df, name, default=""):
+    # the column, or a column of default values if the column is missing
+    if name in df:
+        return df[name]
+    return pd.Series(default, index=df.index, dtype=object)
+
+
+def _map_unique(series, func):
+    # apply func once per distinct value. Many rows share eg. the same isbn
+    values = series.unique()
+    return series.map(dict(zip(values, map(func, values))))
+
+
+def query_frame(df):
+    """Map all rows of the DataFrame at once. Same mapping as `query`.
+
+    Returns a DataFrame with the canonical fields as columns, in the same order
+    and with the same index as df. isbn_10/isbn_13 are None when the isbn is not
+    of that type. Rows that can't be mapped have the reason in the `error`
+    column, otherwise it is NaN. Use `frame_records` to get the records."""
+    out = pd.DataFrame(index=df.index)
+    isbn = _map_unique(_column(df, "ISBN-nr").fillna("").astype(str), isbn_canonical)
+    out["isbn"] = isbn
+    out["title"] = _column(df, "Titel")
+    out["publisher"] = _column(df, "Forlag")
+    out["year"] = _column(df, "Årstal")
+    out["language"] = _column(df, "Sprog").map(sprog_map).fillna("")
+    out["thumbnail"] = ""
+    out["pages"] = _column(df, "Sideantal")
+    out["categories"] = _column(df, "Beskrivelse")
+    out["description"] = ""
+    out["preview_url"] = ""
+
+    # in DBKK db, the authors might be in 'last, first'-name.
+    # lets reverse that. Each author is a row after the explode
+    forfatter = _column(df, "Forfatter")
+    pos = pd.RangeIndex(len(df))
+    authors = forfatter.set_axis(pos).str.replace("&", "og", regex=False)
+    authors = authors.str.split(" og ").explode()
+    authors = authors.str.split(", ").str[::-1].str.join(" ")
+    # and back to a list of authors per row
+    rows = [[] for _ in pos]
+    for n, author in zip(authors.index, authors.tolist()):
+        rows[n].append(author)
+    out["authors"] = pd.Series(rows, index=df.index, dtype=object)
+
+    # loc_id : placering paa hylden
+    loc_id = _column(df, "Beskrivelse", None).map(LOC_TABLE)
+    country = _column(df, "Land", None).map(COUNTRY_TABLE)
+    guide = loc_id == LOC_TABLE["Område/Guide/Ekspedition"]
+    # ints as in LOC_TABLE, eg. 5, or a str for guides, eg. "2.7"
+    location = loc_id.astype("Int64").astype(object)
+    location[guide] = "2." + country[guide].astype("Int64").astype(str)
+    out["location"] = location
+
+    is10 = _map_unique(isbn, is_isbn10).astype(bool)
+    is13 = ~is10 & _map_unique(isbn, is_isbn13).astype(bool)
+    out["isbn_10"] = isbn.map(lambda s: [s]).where(is10, None)
+    out["isbn_13"] = isbn.map(lambda s: [s]).where(is13, None)
+
+    error = pd.Series(None, index=df.index, dtype=object)
+    error[loc_id.isna()] = "unknown Beskrivelse"
+    error[guide & country.isna()] = "unknown Land"
+    error[~forfatter.map(lambda s: isinstance(s, str))] = "Forfatter is not a str"
+    out["error"] = error
+    return out
+
+
+def frame_records(frame):
+    """Yield (index, canonical) for the rows of a frame from `query_frame`.
+
+    canonical is the same dict as returned by `query`. For rows that can't be
+    mapped, canonical is a RecordMappingError instead of being raised, so the
+    caller can decide what to do with the row."""
+    columns = list(frame.columns)
+    for index, values in zip(frame.index, frame.itertuples(index=False, name=None)):
+        canonical = dict(zip(columns, values))
+        error = canonical.pop("error")
+        if isinstance(error, str):
+            yield index, RecordMappingError(
+                f"for ({canonical['isbn']}, {canonical['title']}): {error}"
+            )
+            continue
+        if canonical["isbn_10"] is None:
+            del canonical["isbn_10"]
+        if canonical["isbn_13"] is None:
+            del canonical["isbn_13"]
+        yield index, canonical
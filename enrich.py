@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""Look up the unknown scanned isbns online and add them to the DB.
+
+The barcode scanner records isbns that are not in the DB in `scan_event`. An
+`Enricher` looks them up in the background, while the scanning goes on: the
+isbns are looked up with `openlapi.query` and `googleapi.query` by a few worker
+threads, and the books are inserted by a single writer thread with its own
+connection, with the location of the last scan of the isbn. Both run as a
+`pipeline`, so the number of lookups at a time is bounded by the workers.
+
+    enricher = Enricher(BOOKS_DB)
+    enricher.start()
+    enricher.submit(isbn)      # never blocks
+    print(enricher.status())   # {'pending': 1, 'resolved': 0, ...}
+    enricher.close()
+
+A lookup failing with a network error is retried, the http requests themselves
+are already retried by `helpers.wquery`. Isbns not found online, or failing,
+stay in `scan_event` and are tried again next time.
+
+Enrich all unknown isbns in scan_event from the command line
+python enrich.py --workers 4
+"""
+
+import argparse
+import logging
+import queue
+import random
+import threading
+import time
+from functools import partial
+
+import requests
+
+from bookdb import (
+    create_connection,
+    find_book_by_isbn,
+    get_scanned_isbns,
+    insert_book,
+    sanitize_metadata,
+    upgrade_schema,
+)
+from googleapi import query as gquery
+from helpers import merge_data
+from openlapi import query as oquery
+import pipeline
+
+LOGGER = logging.getLogger(__name__)
+
+BOOKS_DB = "books.sqlite"
+WORKERS = 4
+RETRIES = 3
+BACKOFF = 2.0
+
+# status of an isbn
+PENDING = "pending"
+RESOLVED = "resolved"
+NOT_FOUND = "not_found"
+EXISTS = "exists"
+FAILED = "failed"
+
+LOCATION_SQL = (
+    "SELECT location FROM scan_event WHERE isbn = ? ORDER BY id DESC LIMIT 1"
+)
+
+
+def lookup(isbn, retries=RETRIES, backoff=BACKOFF):
+    """Return the merged data from openlibrary and google for isbn.
+
+    {} if neither have the isbn"""
+    for attempt in range(retries + 1):
+        try:
+            olib = oquery(isbn)
+            goob = gquery(isbn)
+            break
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            LOGGER.debug("lookup of %s failed (%s), retry in %.1fs", isbn, e, delay)
+            time.sleep(delay)
+    data, _ = merge_data(olib, goob)
+    return data
+
+
+class Enricher:
+    """Background lookup and insert of unknown isbns. See the module docstring.
+
+    on_resolved(isbn, book_id) is called from the writer thread for each book
+    inserted."""
+
+    def __init__(
+        self, db_file=BOOKS_DB, workers=WORKERS, retries=RETRIES, on_resolved=None
+    ):
+        self.db_file = db_file
+        self.workers = workers
+        self.retries = retries
+        self.on_resolved = on_resolved
+        # isbn -> (status, message)
+        self.items = {}
+        self._inbox = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = None
+
+    def _set(self, isbn, status, message=""):
+        with self._lock:
+            self.items[isbn] = (status, message)
+
+    def submit(self, isbn):
+        """Queue isbn for lookup, unless it is already queued or done"""
+        with self._lock:
+            if self.items.get(isbn, (None,))[0] in (PENDING, RESOLVED, EXISTS):
+                return
+            self.items[isbn] = (PENDING, "")
+        self._inbox.put(isbn)
+
+    def status(self):
+        """Return the number of isbns per status"""
+        with self._lock:
+            counts = {s: 0 for s in (PENDING, RESOLVED, NOT_FOUND, EXISTS, FAILED)}
+            for status, _ in self.items.values():
+                counts[status] += 1
+        return counts
+
+    def failed(self):
+        with self._lock:
+            return {
+                isbn: message
+                for isbn, (status, message) in self.items.items()
+                if status == FAILED
+            }
+
+    def _source(self):
+        # isbns from submit, until close puts None
+        return iter(self._inbox.get, None)
+
+    def _lookup(self, isbn):
+        """Stage 1: look up isbn online"""
+        return isbn, lookup(isbn, self.retries)
+
+    def _write(self, item, conn):
+        """Stage 2: insert the book, with the location of the last scan"""
+        isbn, data = item
+        if find_book_by_isbn(conn, isbn, "id"):
+            self._set(isbn, EXISTS)
+            return item
+        if not data:
+            self._set(isbn, NOT_FOUND)
+            return item
+        data["isbn"] = isbn
+        row = conn.execute(LOCATION_SQL, (isbn,)).fetchone()
+        data["location"] = row[0] if row else None
+        book_id = insert_book(conn, sanitize_metadata(data))
+        if book_id is None:
+            # insert_book skips a book with the same title and authors
+            self._set(isbn, EXISTS, "same title and authors")
+            return item
+        self._set(isbn, RESOLVED, f"book {book_id}")
+        LOGGER.info("added %s as book %s: %s", isbn, book_id, data.get("title"))
+        if self.on_resolved:
+            self.on_resolved(isbn, book_id)
+        return item
+
+    def _on_error(self, item, e):
+        isbn = item[0] if isinstance(item, tuple) else item
+        self._set(isbn, FAILED, repr(e))
+
+    def _run(self):
+        # only used by the writer thread, but created here
+        conn = create_connection(self.db_file, check_same_thread=False)
+        try:
+            stages = [
+                (self._lookup, self.workers),
+                (partial(self._write, conn=conn), 1),
+            ]
+            self.stats = pipeline.run(self._source(), stages, on_error=self._on_error)
+        finally:
+            conn.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="enricher", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self, wait=True):
+        """Stop after the queued isbns, if wait, else leave them to the daemon
+        threads and return at once"""
+        self._inbox.put(None)
+        if wait and self._thread:
+            self._thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=BOOKS_DB)
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS)
+    parser.add_argument("-r", "--retries", type=int, default=RETRIES)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    conn = create_connection(args.db)
+    upgrade_schema(conn)
+    isbns = [
+        isbn
+        for isbn in get_scanned_isbns(conn)
+        if not find_book_by_isbn(conn, isbn, "id")
+    ]
+    conn.close()
+    print(f"looking up {len(isbns)} unknown isbns")
+
+    enricher = Enricher(args.db, args.workers, args.retries).start()
+    for isbn in isbns:
+        enricher.submit(isbn)
+    enricher.close()
+    print(enricher.status())
+    for isbn, message in enricher.failed().items():
+        print(f"{isbn}: {message}")
+    return enricher
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,180 @@
 #!/usr/bin/env python3
 
 import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 import serial
 from serial.tools.list_ports import comports
 
+from metrics import METRICS
+from webcache import WebCache
+
 LOGGER = logging.getLogger(__name__)
 
+# cache all responses from the web services. Set to False to always ask the
+# services
+USE_CACHE = True
+_cache = None
+_cache_lock = threading.Lock()
+
+# All requests go through one shared session. It keeps a pool of keep-alive
+# connections per host, so the TCP/TLS handshake to openlibrary.org and
+# googleapis.com is only done once per pooled connection.
+# (connect, read) timeout in seconds
+TIMEOUT = (5, 30)
+# retry connection errors, timeouts and these status codes
+RETRIES = 3
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# base delay for the exponential backoff. The delay is jittered
+BACKOFF = 0.5
+# max number of connections kept open per host. Should be >= the number of
+# concurrent lookups
+POOL_SIZE = 16
+_session = None
+_session_lock = threading.Lock()
+
 # validate isbn
 # https://stackoverflow.com/a/14096142
 
 
-def wquery(SERVICE_URL):
-    resp = requests.get(SERVICE_URL)
+def get_cache():
+    """Return the shared web cache. It is opened on first use"""
+    global _cache
+    if not USE_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = WebCache()
+    return _cache
+
+
+def get_session():
+    """Return the shared requests session. It is created on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers["Accept-Encoding"] = "gzip, deflate"
+    return _session
+
+
+def configure_session(timeout=None, retries=None, backoff=None, pool_size=None):
+    """Change the timeouts, retries and pool size. Call before the first query,
+    as the pool size is fixed when the session is created"""
+    global TIMEOUT, RETRIES, BACKOFF, POOL_SIZE, _session
+    TIMEOUT = timeout or TIMEOUT
+    RETRIES = RETRIES if retries is None else retries
+    BACKOFF = BACKOFF if backoff is None else backoff
+    if pool_size and pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        with _session_lock:
+            _session = None
+
+
+def connection_stats():
+    """Return {host: {"requests": n, "connections": n, "reused": n}}
+
+    `reused` is the number of requests that did not need a new connection"""
+    stats = {}
+    session = get_session()
+    adapters = {id(a): a for a in session.adapters.values()}.values()
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            s = stats.setdefault(pool.host, {"requests": 0, "connections": 0})
+            s["requests"] += pool.num_requests
+            s["connections"] += pool.num_connections
+    for s in stats.values():
+        s["reused"] = s["requests"] - s["connections"]
+    return stats
+
+
+def _get(url, headers):
+    # GET with retries of transient failures. Between attempts we sleep
+    # BACKOFF * 2**attempt, jittered so concurrent workers don't retry in sync
+    session = get_session()
+    host = urlparse(url).hostname
+    for attempt in range(RETRIES + 1):
+        METRICS.count("requests", host=host)
+        if attempt:
+            METRICS.count("retries", host=host)
+        try:
+            resp = session.get(url, headers=headers, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == RETRIES:
+                raise
+            LOGGER.debug("%s for %s, retrying", e, url)
+        else:
+            if resp.status_code not in RETRY_STATUS or attempt == RETRIES:
+                return resp
+            LOGGER.debug("status %s for %s, retrying", resp.status_code, url)
+        time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def wquery(SERVICE_URL, use_cache=True):
+    """GET SERVICE_URL and return the json data. The response is cached, unless
+    use_cache is False"""
+    cache = get_cache() if use_cache else None
+    entry = cache.get(SERVICE_URL) if cache else None
+    if entry and entry.fresh:
+        LOGGER.debug("Cached data for %s", SERVICE_URL)
+        METRICS.count("web_cache", result="hit")
+        return entry.data
+
+    # revalidate a stale entry. The service answers `304 Not Modified` if our
+    # copy is still valid
+    headers = {}
+    if entry and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+
+    resp = _get(SERVICE_URL, headers)
+    if resp.status_code == 304 and entry:
+        cache.refresh(SERVICE_URL)
+        METRICS.count("web_cache", result="revalidated")
+        return entry.data
+    if resp.status_code in RETRY_STATUS:
+        # still failing after the retries. Not an answer, so don't return the
+        # body of the error as data
+        resp.raise_for_status()
+    if cache:
+        METRICS.count("web_cache", result="miss")
+
     data = resp.json()
     LOGGER.debug("Raw data from service:\n%s", data)
+    if cache and resp.status_code == 200:
+        cache.put(
+            SERVICE_URL,
+            data,
+            resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"),
+        )
     return data
 
 
+def wfetch(url):
+    """GET url and return the body as bytes, or None if it is not found.
+
+    The request is retried like in `wquery`, but not cached. For cover images"""
+    resp = _get(url, {})
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.content
+
+
 def merge_data(data1, data2):
     """Merge values from data2 into data1 IF the values in data1 is empty or the
     keyword does not exist.
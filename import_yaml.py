@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Import the books listed by hand in books_witout_isbn.yaml.
+
+The books are mostly old books without isbn, entered as
+
+    - author: Eric Shipton
+      title: Bjergenes erobring
+      year: 1966
+      isbn: ~
+      location: 5
+
+A book is skipped if the DB already has its isbn, or, without isbn, a book with
+a similar title and authors (`bookdb.find_similar_book`), eg. 'Bjergenes
+Erobring' by 'Shipton, Eric'. The rest are inserted with the location of the
+label.
+
+python import_yaml.py --dry-run
+python import_yaml.py books_witout_isbn.yaml --db books.sqlite
+"""
+
+import argparse
+import logging
+
+import yaml
+from isbnlib import canonical, notisbn
+
+from bookdb import (
+    SCHEMA_VERSION,
+    create_connection,
+    find_book_by_isbn,
+    find_similar_book,
+    get_locations_id,
+    insert_book,
+    sanitize_metadata,
+    schema_version,
+    upgrade_schema,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+BOOKS_DB = "books.sqlite"
+BOOKS_YAML = "books_witout_isbn.yaml"
+
+
+def read_books(filename):
+    """Return the books of the yaml file as dicts.
+
+    All values are read as strings, so location 2.10 is not the number 2.1"""
+    with open(filename) as f:
+        books = yaml.load(f, Loader=yaml.BaseLoader) or []
+    for book in books:
+        isbn = canonical(book.get("isbn", ""))
+        book["isbn"] = "" if notisbn(isbn) else isbn
+    return books
+
+
+def book_data(book, loc_id_map):
+    """Return the metadata dict of a book from the yaml file, as expected by
+    `sanitize_metadata`. An unknown location label gives no location"""
+    return {
+        "isbn": book["isbn"],
+        "title": book["title"],
+        "authors": book.get("author", ""),
+        "publisher": "",
+        "year": book.get("year", ""),
+        "pages": "",
+        "categories": "",
+        "thumbnail": book.get("frontpage", ""),
+        "location": loc_id_map.get(book["location"]),
+        "language": "",
+        "preview_url": book.get("url", ""),
+        "description": book.get("description", ""),
+    }
+
+
+def find_existing(conn, book):
+    """Return the id of the book in the DB matching book, or None"""
+    if book["isbn"]:
+        row = find_book_by_isbn(conn, book["isbn"], "id")
+        if row:
+            return row[0]
+    match = find_similar_book(conn, book["title"], book.get("author", ""))
+    return match[0] if match else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml", nargs="?", default=BOOKS_YAML)
+    parser.add_argument("--db", default=BOOKS_DB)
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="only show what would be done"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.dry_run:
+        # a dry run never writes to the DB, so it cannot migrate it either
+        conn = create_connection(f"file:{args.db}?mode=ro", uri=True)
+        if schema_version(conn) < SCHEMA_VERSION:
+            conn.close()
+            parser.error(
+                f"{args.db} has an old schema. Run without --dry-run, or "
+                "python bookdb.py --upgrade, first"
+            )
+    else:
+        conn = create_connection(args.db)
+        upgrade_schema(conn)
+    # {1: ('5', 'Biografi/Erindringer/Historie'), ...} -> {'5': 1, ...}
+    loc_id_map = {v[0]: k for k, v in get_locations_id(conn).items()}
+
+    inserted = existing = 0
+    for book in read_books(args.yaml):
+        book_id = find_existing(conn, book)
+        if book_id is not None:
+            existing += 1
+            LOGGER.info("exists as book %s: %s", book_id, book["title"])
+            continue
+        if book["location"] not in loc_id_map:
+            LOGGER.warning("unknown location %s: %s", book["location"], book["title"])
+        inserted += 1
+        if args.dry_run:
+            LOGGER.info("would add: %s", book["title"])
+            continue
+        book_id = insert_book(conn, sanitize_metadata(book_data(book, loc_id_map)))
+        LOGGER.info("added as book %s: %s", book_id, book["title"])
+    conn.close()
+    print(f"{inserted} new books, {existing} already in the DB")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,31 +6,56 @@ from isbnlib.registry import bibformatters, add_service
 # my libs
 from googleapi import query as gquery
 from openlapi import query as oquery
+from openlapi import query_many as oquery_many
 from openlapi import search_book as ol_search_book
 from openlapi import create_book as ol_create_book
 from openlapi import get_edition_from_work as ol_get_edition_from_work
 from dbkkapi import query as dbkkquery
+from dbkkapi import query_frame as dbkkquery_frame
+from dbkkapi import frame_records as dbkk_records
 from bookdb import (
+    BookKeys,
+    BookWriter,
     insert_book,
     sanitize_metadata,
     create_connection,
     book_exist,
+    find_book_by_isbn,
+    find_similar_book,
     get_locations_id,
+    create_journal,
+    get_journal,
+    journal_mark,
+    JOURNAL_DONE,
+    JOURNAL_FAILED,
+    JOURNAL_NOT_ONLINE,
 )
+import helpers
 from helpers import merge_data
 from olib_add_new_book import add_book
+import bookdb
+import mdbstream
+from metrics import METRICS
+import oldump
+import pipeline
 
 import numpy as np
+import requests
 import pandas as pd
 import pandas_access as mdb
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
+import argparse
 import logging
 import pickle
+import threading
 
 logging.basicConfig(level=logging.DEBUG)
 # set the root logger to debug. All other loggers ends here, due to chaining
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
+LOGGER = logging.getLogger(__name__)
 
 UPDATE_DB = False
 UPDATE_DB = True
@@ -41,19 +66,10 @@ BOOKS_DB = "books.sqlite"
 f_isbn = "books_isbn.csv"
 f_noisbn = "books_no_isbn.csv"
 
-# Listing the tables.
-for tbl in mdb.list_tables(db_filename):
-    print(tbl)
-
-# merge de to tabeller
-df1 = mdb.read_table(db_filename, "Udgave", dtype={"Sideantal": "string"})
-df2 = mdb.read_table(db_filename, "Titel")
-df = pd.merge(left=df1, right=df2, left_on="Titel", right_on="Titel")
-
-# Convert missing data Na or NaN to empty strings
-# Not for Land, as we use books with NaN to indicate wrong placement
-df["Forfatter"] = df["Forfatter"].fillna("")
-df["Sideantal"] = df["Sideantal"].fillna("")
+# number of rows being looked up online at the same time
+WORKERS = 8
+# number of isbns looked up at openlibrary in one request, per worker
+BATCH_SIZE = 20
 
 data_isbn = []
 data_noisbn = []
@@ -63,18 +79,99 @@ data_oquery = []
 data_gquery = []
 data_dbkkquery = []
 data_all = []
-
-# create conection to the DB and get the location id,
-# eg: which id does location 2.5 correspond to
-conn = create_connection(BOOKS_DB)
-id_loc_map = get_locations_id(conn)
-
-for index, row in df.iterrows():
-    # if index < 152:
-    #     continue
-
-    # data from: olib, goob, dbkk
-    data_from = "olib"
+# the data_* lists are appended to from several stages
+data_lock = threading.Lock()
+# the import journal is written from several stages
+journal_lock = threading.Lock()
+
+
+def keep(data_list, value):
+    # the data is only kept for SAVEDATA, so memory doesn't grow with the
+    # size of the mdb file
+    if SAVEDATA:
+        with data_lock:
+            data_list.append(value)
+
+
+def row_key(row):
+    # identifies a row from the mdb file in the import journal. The mdb tables
+    # have no id column, so use the columns that make a row unique. A missing
+    # value is the same, whether it is NaN or "" after fillna
+    return "|".join(
+        "" if pd.isna(v) else str(v)
+        for v in (row.get(k, "") for k in ("Titel", "ISBN-nr", "Forfatter", "Årstal"))
+    )
+
+
+def legacy_row_key(row):
+    # the key of row in journals written before ISBN-nr was filled with "",
+    # where a missing value was "nan"
+    return "|".join(
+        "nan" if k == "ISBN-nr" and row.get(k) == "" else str(row.get(k, ""))
+        for k in ("Titel", "ISBN-nr", "Forfatter", "Årstal")
+    )
+
+
+def mark_row(conn, key, status, error=""):
+    with journal_lock:
+        journal_mark(conn, key, status, error)
+
+
+def is_journaled(row, key, journal, only_failed=False):
+    """True if the row was already imported according to the journal.
+
+    If only_failed, all rows but the ones that failed in an earlier run are"""
+    status = journal.get(key)
+    if status is None:
+        status = journal.get(legacy_row_key(row))
+    if only_failed and status != JOURNAL_FAILED:
+        return True
+    return status in (JOURNAL_DONE, JOURNAL_NOT_ONLINE)
+
+
+def read_rows(
+    db_filename, chunksize=mdbstream.CHUNK_SIZE, journal=None, only_failed=False
+):
+    """Stage 1: stream the mdb tables and yield a job for each row.
+
+    The rows already imported according to journal (see `is_journaled`) are
+    skipped, before they are mapped"""
+    # Listing the tables.
+    for tbl in mdb.list_tables(db_filename):
+        print(tbl)
+
+    # merge de to tabeller, a chunk at a time
+    for df in mdbstream.read_udgave_titel(db_filename, chunksize):
+        # Convert missing data Na or NaN to empty strings
+        # Not for Land, as we use books with NaN to indicate wrong placement
+        df["Forfatter"] = df["Forfatter"].fillna("")
+        df["Sideantal"] = df["Sideantal"].fillna("")
+        df["ISBN-nr"] = df["ISBN-nr"].fillna("")
+
+        # Rows are plain dicts, instead of a Series per row from df.iterrows()
+        rows = df.to_dict("records")
+        keys = [row_key(row) for row in rows]
+        if journal or only_failed:
+            todo = [
+                not is_journaled(row, key, journal, only_failed)
+                for row, key in zip(rows, keys)
+            ]
+            rows = [row for row, keep_row in zip(rows, todo) if keep_row]
+            keys = [key for key, keep_row in zip(keys, todo) if keep_row]
+            df = df[todo]
+            if df.empty:
+                continue
+
+        # parse all rows of the chunk using DBKKs db at once
+        with METRICS.time("dbkk_query"):
+            records = dbkk_records(dbkkquery_frame(df))
+        for row, key, (index, dbkk) in zip(rows, keys, records):
+            yield {"index": index, "row": row, "key": key, "dbkk": dbkk}
+
+
+def map_row(job, keys, journal_conn, lookup_conn):
+    """Stage 2: parse the row using DBKKs db and skip books already in the DB"""
+    row = job["row"]
 
     # convert isbn with np.nan to empty string
     isbn = row["ISBN-nr"]
@@ -84,98 +181,327 @@ for index, row in df.iterrows():
         row["ISBN-nr"] = ""
     isbn = canonical(isbn)
 
-    # use DBKKs db, just parse the current row
-    dbkk = dbkkquery(row)
-
-    # check if current book exist in db
+    # use DBKKs db, just parse the current row. The reader might already have
+    # done this for all rows
+    dbkk = job.get("dbkk")
+    if dbkk is None:
+        dbkk = dbkkquery(row)
+    elif isinstance(dbkk, Exception):
+        raise dbkk
+
+    # check if current book exist in db. The keys of all books are loaded
+    # before the import, so this doesn't query the db. Books with isbn are
+    # found by any of their isbn10/isbn13. Books without isbn are also looked
+    # up in the trigram index, to find them under a slightly different title
+    # or authors
     if notisbn(isbn):
-        sql_dict = {k: dbkk[k] for k in ("title", "authors")}
+        exist = keys.exist(title=dbkk["title"], authors=dbkk["authors"])
+        if not exist:
+            with METRICS.time("find_similar_book"):
+                exist = find_similar_book(lookup_conn, dbkk["title"], dbkk["authors"])
+            if exist:
+                METRICS.count("fuzzy_match")
     else:
-        sql_dict = {k: dbkk[k] for k in ("isbn",)}
-    if book_exist(conn, sql_dict):
+        exist = keys.exist(isbn=isbn)
+    METRICS.count("existing", result="hit" if exist else "miss")
+    if exist:
         print("book exist")
-        continue
+        mark_row(journal_conn, job["key"], JOURNAL_DONE)
+        return None
 
-    if (isbn is not np.nan) and (not notisbn(isbn)):
+    job["isbn"] = isbn
+    job["dbkk"] = dbkk
+    return job
 
-        # lookup the isbn. Query all sources to get most info. Then merge
-        olib = oquery(isbn)
-        goob = gquery(isbn)
 
-        data_isbn.append(row)
-    else:
-        # search for the book using title and author
-        book = ol_create_book(dbkk)
-        try:
+def search_no_isbn(dbkk):
+    # search for the book using title and author
+    book = ol_create_book(dbkk)
+    try:
+        with METRICS.time("ol_search_book"):
             olid, work = ol_search_book(book)
-        except Exception as e:
-            olid = ""
-            work = {}
-            print(
-                f"########################\n"
-                f"########################\n"
-                f"exception: {e}"
-                f"########################\n"
-                f"########################\n"
-            )
-        if work == dict():
-            olib = {}
-            data_not_online.append(row)
+    except requests.RequestException:
+        # a failed lookup, not a book missing online. See _result
+        raise
+    except Exception as e:
+        olid = ""
+        work = {}
+        print(
+            f"########################\n"
+            f"########################\n"
+            f"exception: {e}"
+            f"########################\n"
+            f"########################\n"
+        )
+    if work == dict():
+        return {}
+    # rank the editions against the record from DBKKs db
+    with METRICS.time("ol_get_edition"):
+        return ol_get_edition_from_work(olid, dbkk)
+
+
+def _result(future, source, what, jobs):
+    # the result of a lookup, or {} if it failed. A failing lookup doesn't fail
+    # the rest of the batch, only the jobs using it, see merge_row
+    try:
+        return future.result()
+    except Exception as e:
+        LOGGER.warning("%s lookup of %s failed: %r", source, what, e)
+        METRICS.count("lookup_errors", source=source, type=type(e).__name__)
+        for job in jobs:
+            job.setdefault("errors", []).append(e)
+        return {}
+
+
+def fetch_rows(jobs, executor):
+    """Stage 3: lookup a batch of books online.
+
+    The isbns are looked up at openlibrary in a single request. The google
+    lookups and no-isbn searches run at the same time in the executor. A
+    failed lookup is kept in job["errors"], and the other jobs of the batch go
+    on"""
+    isbn_jobs = [job for job in jobs if not notisbn(job["isbn"])]
+    olib = executor.submit(
+        METRICS.timed("oquery", oquery_many), [job["isbn"] for job in isbn_jobs]
+    )
+    for job in jobs:
+        # data from: olib, goob, dbkk
+        job["data_from"] = "olib"
+        if not notisbn(job["isbn"]):
+            # lookup the isbn. Query all sources to get most info. Then merge
+            job["goob"] = executor.submit(METRICS.timed("gquery", gquery), job["isbn"])
         else:
-            olib = ol_get_edition_from_work(olid)
-        goob = {}
-
-        data_noisbn.append(row)
-        data_from = "## no ISBN ##"
-
-    data, updated1 = merge_data(olib, goob)
-    data, updated2 = merge_data(data, dbkk)
+            job["olib"] = executor.submit(search_no_isbn, job["dbkk"])
+            job["goob"] = None
+
+    olib = _result(olib, "oquery", f"{len(isbn_jobs)} isbns", isbn_jobs)
+    for job in jobs:
+        if not notisbn(job["isbn"]):
+            job["olib"] = olib.get(job["isbn"], {})
+            job["goob"] = _result(job["goob"], "gquery", job["isbn"], [job])
+            keep(data_isbn, job["row"])
+        else:
+            job["olib"] = _result(
+                job["olib"], "ol_search", job["dbkk"]["title"], [job]
+            )
+            job["goob"] = {}
+            if job["olib"] == dict():
+                keep(data_not_online, job["row"])
+            keep(data_noisbn, job["row"])
+            job["data_from"] = "## no ISBN ##"
+    return jobs
+
+
+def merge_row(job, loc_id_map):
+    """Stage 4: merge the data from all sources into a DB tuple.
+
+    A row with a failed lookup is not written, but fails with the error of the
+    lookup, so it is journaled as failed and retried by the next import"""
+    if job.get("errors"):
+        raise job["errors"][0]
+    olib, goob, dbkk = job["olib"], job["goob"], job["dbkk"]
+    with METRICS.time("merge_data"):
+        data, updated1 = merge_data(olib, goob)
+        data, updated2 = merge_data(data, dbkk)
     updated = {**updated1, **updated2}
 
     # Find the location id from the location number.
-    data["location"] = id_loc_map[str(data["location"])]
+    data["location"] = loc_id_map[str(data["location"])]
 
     if olib == dict():  # no result from openlibrary
-        data_from = "goob"
+        job["data_from"] = "goob"
     if goob == dict():  # no result from googleapi
-        data_from = "dbkk"
+        job["data_from"] = "dbkk"
+
+    job["data"] = data
+    with METRICS.time("sanitize_metadata"):
+        job["dtuple"] = sanitize_metadata(data)
+    return job
 
-    dtuple = sanitize_metadata(data)
-    r = insert_book(conn, dtuple)
 
-    data_oquery.append(olib)
-    data_gquery.append(goob)
-    data_dbkkquery.append(dbkk)
-    data_all.append(data)
+def write_row(job, writer, keys):
+    """Stage 5: insert the book in the DB.
+
+    The books are written in batches, together with their journal status"""
+    if job["olib"] == dict() and job["goob"] == dict():
+        status = JOURNAL_NOT_ONLINE
+    else:
+        status = JOURNAL_DONE
+    with METRICS.time("insert_book"):
+        writer.add(job["dtuple"], job["key"], status)
+    keys.add(job["dtuple"])
+    METRICS.count("rows", data_from=job["data_from"])
+
+    keep(data_oquery, job["olib"])
+    keep(data_gquery, job["goob"])
+    keep(data_dbkkquery, job["dbkk"])
+    keep(data_all, job["data"])
 
     print(f"#####################\n"
-          f"data pulled from {data_from}\n\n")
-
-if SAVEDATA:
-    d = {
-        "data_all": data_all,
-        "data_oquery": data_oquery,
-        "data_gquery": data_gquery,
-        "data_dbkkquery": data_dbkkquery,
-        "data_isbn": data_isbn,
-        "data_not_online": data_not_online,
-        "data_noisbn": data_noisbn,
-    }
-    with open("data.pickle", "wb") as f:
-        pickle.dump(d, f)
+          f"data pulled from {job['data_from']}\n\n")
+    return job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mdb", default=db_filename, help="the mdb file to import")
+    parser.add_argument("--db", default=BOOKS_DB, help="the sqlite db to import to")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of rows looked up online concurrently",
+    )
+    parser.add_argument(
+        "-q",
+        "--queue-size",
+        type=int,
+        default=pipeline.QUEUE_SIZE,
+        help="max number of rows waiting between two stages",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=mdbstream.CHUNK_SIZE,
+        help="number of rows read from the mdb file at a time",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="number of isbns looked up at openlibrary in one request",
+    )
+    parser.add_argument(
+        "--write-batch",
+        type=int,
+        default=bookdb.BATCH_SIZE,
+        help="number of books written to the DB in one transaction",
+    )
+    parser.add_argument(
+        "--only-failed",
+        action="store_true",
+        help="only retry the rows that failed in an earlier import",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the import journal and process all rows again",
+    )
+    parser.add_argument(
+        "--metrics",
+        default="import_metrics",
+        help="write timings and counters to METRICS.json and METRICS.prom. "
+        "Empty to disable",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        default=0,
+        help="print a progress line every PROGRESS seconds",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always ask the web services, do not use the cached responses",
+    )
+    parser.add_argument(
+        "--oldump",
+        default=oldump.DUMP_DB,
+        help="look up openlibrary in this local dump first, see oldump.py. "
+        "Empty to always ask openlibrary",
+    )
+    args = parser.parse_args(argv)
+    helpers.USE_CACHE = not args.no_cache
+    oldump.DUMP_DB = args.oldump or None
+    # keep a pooled connection per worker and online source
+    helpers.configure_session(pool_size=2 * args.workers)
+
+    # create conection to the DB and get the location id,
+    # eg: which id does location 2.5 correspond to.
+    # conn is used from the writer thread, journal_conn from the mapper and
+    # for failed rows from any stage, lookup_conn for the lookups of the mapper.
+    conn = create_connection(args.db, check_same_thread=False)
+    journal_conn = create_connection(args.db, check_same_thread=False)
+    lookup_conn = create_connection(args.db, check_same_thread=False)
+    # {1: ('5', 'Biografi/Erindringer/Historie'), ...} -> {'5': 1, ...}
+    id_loc_map = get_locations_id(conn)
+    loc_id_map = {v[0]: k for k, v in id_loc_map.items()}
+
+    # resume the import. Rows imported by an earlier run are skipped before
+    # they are mapped or looked up
+    create_journal(conn)
+    journal = {} if args.restart else get_journal(conn)
+    source = read_rows(args.mdb, args.chunk_size, journal, args.only_failed)
+
+    def on_error(job, e):
+        METRICS.count("errors", type=type(e).__name__)
+        mark_row(journal_conn, job["key"], JOURNAL_FAILED, repr(e))
+
+    writer = BookWriter(conn, batch_size=args.write_batch)
+    keys = BookKeys(conn)
+
+    # the google lookups of a batch run in parallel
+    executor = ThreadPoolExecutor(max_workers=2 * args.workers)
+    stages = [
+        (
+            partial(
+                map_row, keys=keys, journal_conn=journal_conn, lookup_conn=lookup_conn
+            ),
+            1,
+        ),
+        (partial(fetch_rows, executor=executor), args.workers, args.batch_size),
+        (partial(merge_row, loc_id_map=loc_id_map), 1),
+        (partial(write_row, writer=writer, keys=keys), 1),
+    ]
+    if args.progress:
+        stop_progress = METRICS.start_progress(args.progress)
+    try:
+        stats = pipeline.run(
+            source, stages, queue_size=args.queue_size, on_error=on_error
+        )
+    finally:
+        executor.shutdown()
+        with METRICS.time("insert_book"):
+            writer.close()
+        if args.progress:
+            stop_progress.set()
+    if args.metrics:
+        METRICS.write(args.metrics)
+    LOGGER.info("inserted %s books, %s already in the DB", writer.inserted, writer.skipped)
+    LOGGER.info("connections: %s", helpers.connection_stats())
+
+    if SAVEDATA:
+        d = {
+            "data_all": data_all,
+            "data_oquery": data_oquery,
+            "data_gquery": data_gquery,
+            "data_dbkkquery": data_dbkkquery,
+            "data_isbn": data_isbn,
+            "data_not_online": data_not_online,
+            "data_noisbn": data_noisbn,
+        }
+        with open("data.pickle", "wb") as f:
+            pickle.dump(d, f)
+
+    # # insert book in DB
+    #
+    # # Save (commit) the changes
+    conn.commit()
+
+    # # We can also close the connection if we are done with it.
+    # # Just be sure any changes have been committed or they will be lost.
+    # conn.close()
+    return stats
+
+
+if __name__ == "__main__":
+    main()
 
 # f2hDaG5tJTaGAbF
 #
 
-# # insert book in DB
-#
-# # Save (commit) the changes
-conn.commit()
-
-# # We can also close the connection if we are done with it.
-# # Just be sure any changes have been committed or they will be lost.
-# conn.close()
-
 
 # # update openlibrary with info from DBKK db
 # if bool(updated) and data_from == "olib":
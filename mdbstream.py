@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Stream the tables of DBKKs mdb file in chunks.
+
+`pandas_access.read_table` pipes the output of `mdb-export` into
+`pd.read_csv`. With a chunksize, the csv is parsed while `mdb-export` is still
+writing, so only one chunk of rows is in memory at a time and the first rows are
+available at once.
+
+Udgave (editions) is joined to Titel chunk by chunk. Titel has a row per title
+and is kept in memory as the lookup side of the join; Udgave, the larger table,
+is streamed. Each chunk is joined with `pd.merge`, so the result is the same as
+merging the full tables, in the same order.
+
+Example
+
+    for df in read_udgave_titel("bjerg2003.mdb"):
+        print(len(df))
+"""
+
+import logging
+
+import pandas as pd
+import pandas_access as mdb
+
+from metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# rows per chunk
+CHUNK_SIZE = 500
+
+
+def read_chunks(db_filename, table, chunksize=CHUNK_SIZE, **kwargs):
+    """Yield the rows of table as DataFrames of up to chunksize rows.
+
+    kwargs are passed on to `pandas_access.read_table`, eg. dtype"""
+    reader = mdb.read_table(db_filename, table, chunksize=chunksize, **kwargs)
+    # the reader keeps the `mdb-export` pipe open until all rows are read
+    with reader:
+        n = 0
+        while True:
+            # time the reading/parsing, not the consumer of the chunk
+            with METRICS.time("mdb_read"):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            LOGGER.debug("%s: chunk %s with %s rows", table, n, len(chunk))
+            n += 1
+            yield chunk
+
+
+def read_udgave_titel(db_filename, chunksize=CHUNK_SIZE):
+    """Yield chunks of Udgave joined with Titel on the `Titel` column"""
+    titel = pd.concat(read_chunks(db_filename, "Titel", chunksize), ignore_index=True)
+    offset = 0
+    for chunk in read_chunks(
+        db_filename, "Udgave", chunksize, dtype={"Sideantal": "string"}
+    ):
+        df = pd.merge(left=chunk, right=titel, left_on="Titel", right_on="Titel")
+        # number the rows across chunks, like a merge of the full tables
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield df
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Timings and counters for the import.
+
+Time a stage and count events on the shared METRICS
+
+    with METRICS.time("oquery"):
+        olib = oquery_many(isbns)
+    gquery = METRICS.timed("gquery", gquery)
+    METRICS.count("rows", data_from="olib")
+
+At the end of a run, write a json summary and a Prometheus text-format file
+(for the node_exporter textfile collector)
+
+    METRICS.write("import_metrics")  # import_metrics.json, import_metrics.prom
+
+Each timing is a lock and two perf_counter calls, so the metrics can stay on.
+"""
+
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = "bibliotek"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the last bucket, ie. +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (le, count) as in the prometheus format
+        total = 0
+        for le, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += n
+            yield le, total
+
+
+def _labels(labels):
+    # a hashable key for the labels of a counter
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # stage -> Histogram
+        self.timings = {}
+        # name -> {labels: count}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self.timings.get(stage)
+            if hist is None:
+                hist = self.timings[stage] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage, func):
+        """Return func, timed as stage"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def count(self, name, n=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + n
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self.counters.get(name, {}).get(_labels(labels), 0)
+
+    def summary(self):
+        """Return the metrics as a dict, for json"""
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": h.count,
+                    "seconds": round(h.sum, 6),
+                    "mean_ms": round(1000 * h.sum / h.count, 3) if h.count else None,
+                    "buckets": {str(le): n for le, n in h.cumulative()},
+                }
+                for stage, h in self.timings.items()
+            }
+            counters = {
+                name: {
+                    ",".join(f"{k}={v}" for k, v in key) or "total": n
+                    for key, n in counter.items()
+                }
+                for name, counter in self.counters.items()
+            }
+        return {
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def prometheus(self):
+        """Return the metrics in the prometheus text format"""
+        lines = []
+        with self._lock:
+            name = f"{PREFIX}_stage_seconds"
+            lines.append(f"# HELP {name} Wall time per call of an import stage.")
+            lines.append(f"# TYPE {name} histogram")
+            for stage, h in sorted(self.timings.items()):
+                for le, n in h.cumulative():
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {n}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+            for counter, values in sorted(self.counters.items()):
+                name = f"{PREFIX}_{counter}_total"
+                lines.append(f"# TYPE {name} counter")
+                for key, n in sorted(values.items()):
+                    lines.append(f"{name}{_format_labels(key)} {n}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, prefix):
+        """Write prefix.json and prefix.prom"""
+        with open(f"{prefix}.json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(f"{prefix}.prom", "w") as f:
+            f.write(self.prometheus())
+        LOGGER.info("metrics written to %s.json and %s.prom", prefix, prefix)
+
+    def start_progress(self, interval, counter="rows", out=print):
+        """Print a progress line every interval seconds, from a daemon thread.
+
+        Returns an Event, set it to stop"""
+        stop = threading.Event()
+
+        def progress():
+            while not stop.wait(interval):
+                with self._lock:
+                    rows = sum(self.counters.get(counter, {}).values())
+                elapsed = time.time() - self.started
+                out(f"progress: {rows} {counter} in {elapsed:.0f}s, "
+                    f"{rows / elapsed:.1f} {counter}/s")
+
+        threading.Thread(target=progress, daemon=True).start()
+        return stop
+
+
+# shared by all modules of the import
+METRICS = Metrics()
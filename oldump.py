@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+"""Local copy of the openlibrary data, from the openlibrary dumps.
+
+openlibrary publishes dumps of all editions, works and authors,
+https://openlibrary.org/developers/dumps. A dump is a gzipped file with a line
+per record, as tab separated columns
+
+    type  key  revision  last_modified  json
+
+The dump is read line by line and the editions, works and authors are written
+in batches to a small sqlite DB, so the memory used doesn't depend on the size
+of the dump. Only the fields used by `openlapi` are kept, and the editions and
+works can be filtered by language and subject. The subjects are on the works,
+so the works dump must be read before the editions. The authors are never
+filtered. The DB is indexed by isbn13,
+olid and normalized title and author.
+
+`openlapi.query`, `query_many`, `search_book` and `get_edition_from_work` look
+in the DB first, if DUMP_DB exists, and only ask openlibrary.org for what is
+not there.
+
+python oldump.py ol_dump_authors_latest.txt.gz ol_dump_works_latest.txt.gz \
+    ol_dump_editions_latest.txt.gz --language dan,eng,ger,nor,swe
+python oldump.py --isbn 8789077903
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from bookdb import isbn13_list
+from metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# set to None to never use the local copy
+DUMP_DB = "oldump.sqlite"
+_dump = None
+_dump_lock = threading.Lock()
+
+# records written per transaction
+BATCH_SIZE = 5000
+COVER_URL = "https://covers.openlibrary.org/b/id/{id}-M.jpg"
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS record (
+        olid TEXT NOT NULL,
+        work TEXT,
+        title_key TEXT,
+        data TEXT,
+        PRIMARY KEY (olid)
+);
+CREATE INDEX IF NOT EXISTS record_title_key ON record (title_key);
+CREATE INDEX IF NOT EXISTS record_work ON record (work);
+CREATE TABLE IF NOT EXISTS record_isbn (
+        isbn13 TEXT NOT NULL,
+        olid TEXT NOT NULL,
+        PRIMARY KEY (isbn13, olid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS record_author (
+        olid TEXT NOT NULL,
+        author TEXT NOT NULL,
+        position INTEGER,
+        PRIMARY KEY (olid, author)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS record_author_author ON record_author (author);
+CREATE TABLE IF NOT EXISTS author (
+        olid TEXT NOT NULL,
+        name TEXT,
+        name_key TEXT,
+        PRIMARY KEY (olid)
+);
+CREATE INDEX IF NOT EXISTS author_name_key ON author (name_key);
+"""
+
+
+def text_key(s):
+    """Normalize a title or name for lookups: words only, no case, so
+    "Bjergenes Erobring." -> "bjergenes erobring" """
+    return " ".join(re.findall(r"\w+", str(s or "").casefold()))
+
+
+def _olid(key):
+    # "/books/OL11372034M" -> "OL11372034M"
+    return key.rsplit("/", 1)[-1]
+
+
+def _text(value):
+    # descriptions are either a string or {"type": "/type/text", "value": ..}
+    if isinstance(value, dict):
+        return value.get("value", "")
+    return value or ""
+
+
+def read_dump(filename):
+    """Yield (type, key, json) for each line of a dump, gzipped or not.
+
+    The json is not parsed, as most lines are usually filtered out by type"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t", 4)
+            if len(columns) != 5:
+                LOGGER.debug("skipping malformed line %r", line[:80])
+                continue
+            yield columns[0], columns[1], columns[4]
+
+
+def _languages(record):
+    # {"eng", "dan"} from [{"key": "/languages/eng"}, ..]
+    return {_olid(lang["key"]) for lang in record.get("languages", [])}
+
+
+def keep(record, languages=(), subjects=()):
+    """True if record has one of the languages and one of the subjects.
+
+    An empty filter keeps all. Works, and some editions, have no language, so
+    only the records with a language are filtered on language. Subjects match
+    on any part of a subject, eg. 'mountain' matches 'Mountaineering'. Most
+    editions have no subjects, see `_keep`"""
+    if languages and "languages" in record and not _languages(record) & languages:
+        return False
+    if subjects:
+        names = " | ".join(record.get("subjects", [])).casefold()
+        if not any(subject in names for subject in subjects):
+            return False
+    return True
+
+
+def _keep(conn, type_, record, languages, subjects, kept_works):
+    # the subjects are on the works, so an edition of a work is kept if the work
+    # was kept, ie. is in the DB or in kept_works, if not written yet. Only
+    # editions without a work are filtered on their own subjects
+    if type_ != "edition" or not subjects or not record.get("works"):
+        return keep(record, languages, subjects)
+    if not keep(record, languages):
+        return False
+    for work in record["works"]:
+        olid = _olid(work["key"])
+        if olid in kept_works or conn.execute(
+            "SELECT 1 FROM record WHERE olid = ?", (olid,)
+        ).fetchone():
+            return True
+    return False
+
+
+def edition_data(record):
+    """Return the edition as a record of the openlibrary books api (with
+    jscmd=data), as used by `openlapi._mapper`. The authors are filled in
+    on lookup"""
+    olid = _olid(record["key"])
+    data = {"key": record["key"], "title": record.get("title", "")}
+    for name in ("subtitle", "publish_date", "number_of_pages"):
+        if record.get(name):
+            data[name] = record[name]
+    if record.get("publishers"):
+        data["publishers"] = [{"name": p} for p in record["publishers"]]
+    if record.get("subjects"):
+        data["subjects"] = [{"name": s} for s in record["subjects"]]
+    covers = [c for c in record.get("covers", []) if c and c > 0]
+    if covers:
+        data["cover"] = {"medium": COVER_URL.format(id=covers[0])}
+    if record.get("description"):
+        data["description"] = _text(record["description"])
+    identifiers = {
+        "isbn_10": record.get("isbn_10", []),
+        "isbn_13": record.get("isbn_13", []),
+        "openlibrary": [olid],
+        "lccn": record.get("lccn", []),
+        "oclc": record.get("oclc_numbers", []),
+        **record.get("identifiers", {}),
+    }
+    data["identifiers"] = {k: v for k, v in identifiers.items() if v}
+    if record.get("languages"):
+        data["languages"] = [{"key": lang["key"]} for lang in record["languages"]]
+    return data
+
+
+def _authors(record):
+    # the author keys of an edition [{"key": ..}] or a work
+    # [{"author": {"key": ..}}]
+    keys = []
+    for author in record.get("authors", []):
+        key = author.get("key") or author.get("author", {}).get("key")
+        if key and _olid(key) not in keys:
+            keys.append(_olid(key))
+    return keys
+
+
+class _Batch:
+    # rows waiting to be written, per insert statement
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.size = size
+        self.rows = {}
+        self.n = 0
+
+    def add(self, sql, rows):
+        self.rows.setdefault(sql, []).extend(rows)
+
+    def record_done(self):
+        # True if the batch was written
+        self.n += 1
+        if self.n >= self.size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        with self.conn:
+            for sql, rows in self.rows.items():
+                self.conn.executemany(sql, rows)
+        self.rows = {}
+        self.n = 0
+
+
+RECORD_SQL = (
+    "INSERT OR REPLACE INTO record (olid, work, title_key, data) VALUES(?, ?, ?, ?)"
+)
+ISBN_SQL = "INSERT OR IGNORE INTO record_isbn (isbn13, olid) VALUES(?, ?)"
+AUTHOR_SQL = (
+    "INSERT OR REPLACE INTO record_author (olid, author, position) VALUES(?, ?, ?)"
+)
+NAME_SQL = "INSERT OR REPLACE INTO author (olid, name, name_key) VALUES(?, ?, ?)"
+
+
+def ingest(conn, filename, languages=(), subjects=(), batch_size=BATCH_SIZE):
+    """Add the editions, works and authors of the dump in filename to the DB.
+
+    Safe to run again, eg. after an interrupted ingest. Returns the number of
+    records kept per type, and the number skipped by the filters. The authors
+    are never filtered. With subjects, the works must be ingested before the
+    editions, as the editions of the kept works are kept"""
+    conn.executescript(SCHEMA_SQL)
+    languages = set(languages)
+    subjects = [s.casefold() for s in subjects]
+    counts = {}
+    # the works kept, but not written yet. The written ones are looked up in the
+    # DB, so the memory used doesn't grow with the dump
+    kept_works = set()
+    batch = _Batch(conn, batch_size)
+    for type_, key, line in read_dump(filename):
+        type_ = type_.rsplit("/", 1)[-1]
+        if type_ not in ("edition", "work", "author"):
+            continue
+        record = json.loads(line)
+        olid = _olid(key)
+        if type_ == "author":
+            name = record.get("name", "")
+            batch.add(NAME_SQL, [(olid, name, text_key(name))])
+        elif not _keep(conn, type_, record, languages, subjects, kept_works):
+            counts["skipped"] = counts.get("skipped", 0) + 1
+            continue
+        elif type_ == "edition":
+            works = [_olid(w["key"]) for w in record.get("works", [])]
+            data = edition_data(record)
+            title = data["title"]
+            if data.get("subtitle"):
+                title = f"{title} - {data['subtitle']}"
+            data = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+            batch.add(
+                RECORD_SQL,
+                [(olid, works[0] if works else None, text_key(title), data)],
+            )
+            isbns = isbn13_list(
+                *record.get("isbn_13", []), *record.get("isbn_10", [])
+            )
+            batch.add(ISBN_SQL, [(isbn, olid) for isbn in isbns])
+        else:
+            if subjects:
+                kept_works.add(olid)
+            data = {"key": key, "title": record.get("title", "")}
+            if record.get("first_publish_date"):
+                data["first_publish_date"] = record["first_publish_date"]
+            data = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+            batch.add(RECORD_SQL, [(olid, None, text_key(record.get("title")), data)])
+        if type_ != "author":
+            batch.add(
+                AUTHOR_SQL,
+                [(olid, author, n) for n, author in enumerate(_authors(record))],
+            )
+        counts[type_] = counts.get(type_, 0) + 1
+        if batch.record_done():
+            kept_works.clear()
+    batch.flush()
+    return counts
+
+
+class OLDump:
+    """Lookups in the local copy of openlibrary. Shared by the threads of the
+    import, like `webcache.WebCache`"""
+
+    def __init__(self, db_file=DUMP_DB):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            f"file:{db_file}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    def _edition(self, olid, data):
+        # the edition with the names of its authors
+        data = json.loads(data)
+        names = self.conn.execute(
+            "SELECT a.name FROM record_author r JOIN author a ON a.olid = r.author "
+            "WHERE r.olid = ? ORDER BY r.position",
+            (olid,),
+        ).fetchall()
+        if names:
+            data["authors"] = [{"name": name} for (name,) in names]
+        return data
+
+    def edition(self, olid):
+        """Return the edition as a books api record, or None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data FROM record WHERE olid = ? AND olid LIKE '%M'", (olid,)
+            ).fetchone()
+            return self._edition(olid, row[0]) if row else None
+
+    def by_isbn(self, isbn):
+        """Return the first edition with isbn (10 or 13) as a books api record,
+        or None"""
+        isbns = isbn13_list(isbn)
+        if not isbns:
+            return None
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT r.olid, r.data FROM record_isbn i "
+                "JOIN record r ON r.olid = i.olid WHERE i.isbn13 = ? "
+                "ORDER BY r.olid LIMIT 1",
+                (isbns[0],),
+            ).fetchone()
+            return self._edition(*row) if row else None
+
+    def search(self, title, author=""):
+        """Return the work (or edition without a work) with title and author as
+        a search.json doc, or {}. Works are preferred"""
+        sql = "SELECT olid, work, data FROM record WHERE title_key = ?"
+        params = [text_key(title)]
+        if author:
+            sql += (
+                " AND olid IN (SELECT r.olid FROM author a JOIN record_author r "
+                "ON r.author = a.olid WHERE a.name_key = ?)"
+            )
+            params.append(text_key(author))
+        sql += " ORDER BY olid LIKE '%M', olid LIMIT 1"
+        with self._lock:
+            row = self.conn.execute(sql, params).fetchone()
+        if not row:
+            return {}
+        olid, work, data = row
+        data = json.loads(data)
+        if work:
+            return {"key": f"/works/{work}", "title": data["title"]}
+        return {"key": data["key"], "title": data["title"]}
+
+    def work_editions(self, olid):
+        """Return the editions of the work olid, as entries of
+        /works/<olid>/editions.json"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT data FROM record WHERE work = ? ORDER BY olid", (olid,)
+            ).fetchall()
+        entries = []
+        for (data,) in rows:
+            data = json.loads(data)
+            entries.append(
+                {
+                    "key": data["key"],
+                    "publish_date": data.get("publish_date", ""),
+                    "publishers": [p["name"] for p in data.get("publishers", [])],
+                    "languages": data.get("languages", []),
+                }
+            )
+        return entries
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def get_dump():
+    """Return the shared OLDump, or None if there is no DUMP_DB. It is opened on
+    first use"""
+    global _dump
+    with _dump_lock:
+        if _dump is None and DUMP_DB and os.path.exists(DUMP_DB):
+            _dump = OLDump(DUMP_DB)
+        return _dump
+
+
+def lookup(name, func, *args):
+    """Call func(*args) on the shared dump and count the hits and misses. None
+    if there is no dump"""
+    dump = get_dump()
+    if dump is None:
+        return None
+    res = getattr(dump, func)(*args)
+    METRICS.count("oldump", lookup=name, result="hit" if res else "miss")
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dumps", nargs="*", help="dump files, .txt.gz or .txt")
+    parser.add_argument("--db", default=DUMP_DB)
+    parser.add_argument(
+        "--language", default="", help="keep editions in these, eg. dan,eng"
+    )
+    parser.add_argument(
+        "--subject",
+        default="",
+        help="keep works with these subjects, eg. climbing, and their editions",
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--isbn", help="look up isbn in the DB")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    languages = [s for s in args.language.split(",") if s]
+    subjects = [s for s in args.subject.split(",") if s]
+    if args.dumps:
+        conn = sqlite3.connect(args.db)
+        # the DB can be built again from the dump, so don't wait for the disk
+        conn.execute("PRAGMA synchronous = OFF")
+        for filename in args.dumps:
+            start = time.perf_counter()
+            counts = ingest(conn, filename, languages, subjects, args.batch_size)
+            LOGGER.info(
+                "%s: %s in %.0fs", filename, counts, time.perf_counter() - start
+            )
+        conn.close()
+    if args.isbn:
+        print(json.dumps(OLDump(args.db).by_isbn(args.isbn), indent=2))
+
+
+if __name__ == "__main__":
+    main()
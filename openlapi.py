@@ -8,10 +8,15 @@ https://openlibrary.org/api/books?bibkeys=ISBN:184195215X&jscmd=data&format=json
 Search for a book on openlibrary.org, using title and optionally author
 """
 
+import functools
 import logging
 import re
-from helpers import wquery
+from urllib.parse import urlencode
+
+from helpers import get_cache, merge_data, wquery
+import oldump
 from _exceptions import RecordMappingError, ISBNNotConsistentError
+from metrics import METRICS
 import argparse
 from olclient.openlibrary import OpenLibrary
 import olclient.common as ol_common
@@ -20,6 +25,41 @@ import olclient.common as ol_common
 SERVICE_URL = (
     "http://openlibrary.org/api/books?bibkeys=" "{bibkey}:{key}&format=json&jscmd=data"
 )
+# the endpoint accepts a comma separated list of bibkeys, eg.
+# bibkeys=ISBN:184195215X,ISBN:0094676402
+BATCH_URL = "http://openlibrary.org/api/books?bibkeys={bibkeys}&format=json&jscmd=data"
+# max number of keys in one request. Keeps the url at a sane length
+BATCH_SIZE = 50
+ALLOWED_KEYS = ["ISBN", "LCCN", "OCLC", "OLID"]
+# search for works. Only the fields we use are returned
+SEARCH_URL = "http://openlibrary.org/search.json?{query}"
+SEARCH_FIELDS = "key,title,author_name,edition_key,first_publish_year"
+SEARCH_LIMIT = 1
+# number of searches remembered. Many editions share title and author
+SEARCH_CACHE_SIZE = 4096
+# editions of a work. Each entry has publishers, publish_date and languages
+EDITIONS_URL = "http://openlibrary.org/works/{olid}/editions.json?limit={limit}"
+# max number of editions considered for a work, and number of the best ranked
+# editions looked up
+MAX_EDITIONS = 100
+TOP_K = 3
+# openlibrary uses MARC language codes. Keys are the languages from dbkkapi
+LANGUAGE_CODES = {
+    "French": "fre",
+    "Danish": "dan",
+    "English": "eng",
+    "German": "ger",
+    "Norwegian": "nor",
+    "Swedish": "swe",
+    "Spanish": "spa",
+    "Czech": "cze",
+    "Slovenian": "slv",
+    "Italian": "ita",
+    "Polish": "pol",
+    "Portuguese": "por",
+    "Icelandic": "ice",
+    "Japanese": "jpn",
+}
 LOGGER = logging.getLogger(__name__)
 
 
@@ -104,15 +144,90 @@ def _records(key, bibkey, data):
     return _mapper(records)
 
 
+def _local(key, bibkey):
+    # the record from the local openlibrary dump, or None. Only isbn and olid
+    # are indexed there
+    if bibkey == "ISBN":
+        return oldump.lookup("isbn", "by_isbn", key)
+    if bibkey == "OLID":
+        return oldump.lookup("olid", "edition", key)
+    return None
+
+
 def query(key, bibkey="ISBN"):
-    ALLOWED_KEYS = ["ISBN", "LCCN", "OCLC", "OLID"]
-    """Query the openlibrary.org service for metadata."""
+    """Query the openlibrary.org service for metadata.
+
+    The local openlibrary dump is used, if it has the book"""
     if not bibkey.upper() in ALLOWED_KEYS:
         raise KeyError(f"wrong bibkey {bibkey}. Not of the type {ALLOWED_KEYS}")
+    records = _local(key, bibkey.upper())
+    if records:
+        return _mapper(records)
     data = wquery(SERVICE_URL.format(bibkey=bibkey, key=key))
     return _records(key, bibkey, data)
 
 
+def _key_url(key, bibkey):
+    # the url of a single key. The responses of a batch are cached per key under
+    # this url, so they are found by `query` and by batches of other keys
+    return SERVICE_URL.format(bibkey=bibkey, key=key)
+
+
+def _mapped(key, bibkey, data):
+    # _records, but a record that cannot be mapped is logged and returned as {}
+    try:
+        return _records(key, bibkey, data)
+    except RecordMappingError as e:
+        LOGGER.debug("RecordMappingError for %s:%s, %s", bibkey, key, e)
+        return {}
+
+
+def query_many(keys, bibkey="ISBN", batch_size=BATCH_SIZE):
+    """Query the openlibrary.org service for metadata of several books.
+
+    Up to batch_size keys are looked up in one request. Returns a dict
+    {key: canonical}, where canonical is the same as returned by `query`, ie.
+    {} if openlibrary have no data for the key. A record that cannot be mapped
+    is logged and returned as {}, so one bad record doesn't fail the whole
+    batch. Keys found in the local openlibrary dump or in the web cache are not
+    requested, and the response is cached per key."""
+    if not bibkey.upper() in ALLOWED_KEYS:
+        raise KeyError(f"wrong bibkey {bibkey}. Not of the type {ALLOWED_KEYS}")
+    bibkey = bibkey.upper()
+    # remove duplicates, but keep the order
+    keys = list(dict.fromkeys(keys))
+
+    res = {}
+    for key in keys:
+        records = _local(key, bibkey)
+        if records:
+            res[key] = _mapped(key, bibkey, {f"{bibkey}:{key}": records})
+    cache = get_cache()
+    if cache:
+        for key in keys:
+            if key in res:
+                continue
+            entry = cache.get(_key_url(key, bibkey))
+            if entry and entry.fresh:
+                METRICS.count("web_cache", result="hit")
+                res[key] = _mapped(key, bibkey, entry.data)
+    keys = [key for key in keys if key not in res]
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i : i + batch_size]
+        bibkeys = ",".join(f"{bibkey}:{key}" for key in batch)
+        # not cached as a whole, the next batches will hold other keys
+        data = wquery(BATCH_URL.format(bibkeys=bibkeys), use_cache=False)
+        for key in batch:
+            keystr = f"{bibkey}:{key}"
+            if cache:
+                METRICS.count("web_cache", result="miss")
+                # {} for a key openlibrary doesn't have, like `query` would get
+                record = {keystr: data[keystr]} if keystr in data else {}
+                cache.put(_key_url(key, bibkey), record)
+            res[key] = _mapped(key, bibkey, data)
+    return res
+
+
 def create_book(data):
     # create an `OL` book instance using title and author.
     # Needed for `seach_book`
@@ -138,26 +253,51 @@ def create_book(data):
     )
 
 
-def search_book(ol_book):
-    "Search for a book using title and author"
+def _normalize(s):
+    # lowercase without punctuation, so "Bjergenes Erobring." and
+    # "bjergenes erobring" is the same search
+    return " ".join(re.findall(r"\w+", (s or "").lower()))
 
-    OL = OpenLibrary()
-    work = OL.Work.search(title=ol_book.title, author=ol_book.primary_author.name)
+
+@functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _search(title, author):
+    # the first matching work, as a search document. Exceptions are not cached
+    doc = oldump.lookup("search", "search", title, author)
+    if doc:
+        return doc
+    query = {"title": title, "fields": SEARCH_FIELDS, "limit": SEARCH_LIMIT}
+    if author:
+        query["author"] = author
+    data = wquery(SEARCH_URL.format(query=urlencode(query)))
+    docs = data.get("docs", [])
+    return docs[0] if docs else {}
+
+
+def search_book(ol_book):
+    """Search for a book using title and author, in the local openlibrary dump
+    first.
+
+    Returns the Work olid and the search document, or ("", {}) if nothing is
+    found. Searches are remembered on the normalized title and primary author.
+    A failed request raises requests.RequestException, so the caller can tell
+    it from a book openlibrary doesn't have"""
+    author = ol_book.primary_author.name if ol_book.primary_author else ""
+    try:
+        work = _search(_normalize(ol_book.title), _normalize(author))
+    except ValueError as e:
+        # the response is not json
+        LOGGER.warning("search failed for %s: %s, %s", author, ol_book.title, e)
+        return "", {}
 
     LOGGER.debug(
         f"Work found from search using:"
-        f"{ol_book.primary_author.name}: {ol_book.title}\n"
+        f"{author}: {ol_book.title}\n"
         f"{work}"
     )
 
-    try:
-        identifiers = get_identifiers(work.identifiers)
-        olid = identifiers["olid"][0]
-    except:
-        olid = ""
-        work = {}
-
-    return olid, work
+    # key is eg. "/works/OL45883W"
+    olid = work["key"].split("/")[-1] if work else ""
+    return olid, dict(work)
 
 
 def parse_edition(edition):
@@ -174,30 +314,80 @@ def parse_edition(edition):
     return d
 
 
-def get_edition_from_work(olid):
+def _year(date):
+    # first 4 digit number in date, eg. 1966 from "ca. 1966" or 1966.0
+    match = re.search(r"\d{4}", str(date or ""))
+    return int(match.group(0)) if match else None
+
+
+def _words(s):
+    return {w for w in re.findall(r"\w+", str(s or "").lower()) if len(w) > 3}
+
+
+def rank_editions(editions, data=None):
+    """Sort the editions, best match to data (eg. from dbkkapi) first.
+
+    editions are entries from EDITIONS_URL. Editions are ranked by
+    1. having the same language
+    2. the smallest difference in publish year
+    3. sharing a word with the publisher
+    and at last by olid, so the order is always the same."""
+    data = data or {}
+    codes = {
+        LANGUAGE_CODES.get(lang)
+        for lang in str(data.get("language") or "").split("/")
+    } - {None}
+    year = _year(data.get("year"))
+    publisher = _words(data.get("publisher"))
+
+    def key(edition):
+        languages = {lang["key"].split("/")[-1] for lang in edition.get("languages", [])}
+        edition_year = _year(edition.get("publish_date"))
+        if year is None or edition_year is None:
+            distance = 9999
+        else:
+            distance = abs(year - edition_year)
+        publishers = set().union(*map(_words, edition.get("publishers", [])))
+        return (
+            not (codes & languages),
+            distance,
+            not (publisher & publishers),
+            edition["key"],
+        )
+
+    return sorted(editions, key=key)
+
+
+def get_edition_from_work(olid, data=None, top_k=TOP_K):
     """Get Work and related Editions from Work olid
 
-    The individual editions are parsed and merged into a dict"""
+    The editions are ranked against data, eg. the record from dbkkapi, and only
+    the top_k are looked up, in a single request. The best edition is used, with
+    empty fields filled in from the next ones"""
 
     # determine if we have an Edition(M) or Work(W) olid.
     if olid.endswith("M"):
         olids = [olid]
     elif olid.endswith("W"):
-        OL = OpenLibrary()
-        # get work and related Editions. Convert Edition class to dict
-        work = OL.Work.get(olid)
-        editions = [vars(e) for e in work.editions]
-        olids = [edition["olid"] for edition in editions]
+        # get the related Editions, from the local openlibrary dump if it
+        # has the work
+        entries = oldump.lookup("editions", "work_editions", olid)
+        if not entries:
+            res = wquery(EDITIONS_URL.format(olid=olid, limit=MAX_EDITIONS))
+            entries = res.get("entries", [])
+        editions = rank_editions(entries, data)[:top_k]
+        # key is eg. "/books/OL11372034M"
+        olids = [edition["key"].split("/")[-1] for edition in editions]
     else:
         raise KeyError(f"missing/wrong Work olid. Should end with 'M' or 'W'")
 
     # For simplicity we lookup the Edition olid using request, instead of
-    # parsing the OL class
+    # parsing the edition entries. All editions are looked up in a single request
+    results = query_many(olids, bibkey="OLID")
     d = {}
     for olid in olids:
-        res = query(olid, bibkey="OLID")
-        d = {**d, **res}
-        # LOGGER.debug(f"{olid}: {res}")
+        d, _ = merge_data(d, results[olid])
+        # LOGGER.debug(f"{olid}: {results[olid]}")
     return d
 
 
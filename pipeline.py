@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""Run an import as a chain of stages joined by bounded queues.
+
+Each stage is a function taking one item and returning the item for the next
+stage (or `None` to drop it). A stage can run in several worker threads. The
+queues between the stages are bounded, so a fast stage blocks when the next
+stage falls behind (backpressure) instead of piling up rows in memory.
+
+    reader -> [q] -> mapper -> [q] -> fetchers (xN) -> [q] -> merger -> [q] -> writer
+
+Example
+
+    stages = [(map_row, 1), (fetch_row, 8), (merge_row, 1), (write_row, 1)]
+    stats = run(rows, stages, queue_size=32)
+
+Use functools.partial to bind extra arguments, like a DB connection, to a stage.
+
+A stage given as (func, workers, batch) gets a list of up to `batch` items and
+returns a list of items for the next stage. A batch is passed on as soon as it
+is full, or when no new item arrives within BATCH_WAIT seconds.
+"""
+
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_SIZE = 32
+BATCH_WAIT = 0.2
+# marks the end of the stream. Passed on from stage to stage
+_DONE = object()
+
+
+def _name(func):
+    # stages are often functools.partial objects, which have no __name__
+    return getattr(func, "func", func).__name__
+
+
+def _failed(func, items, exc, stats, lock, on_error):
+    # don't stop the whole import because of a single bad row
+    LOGGER.exception("stage %s failed for %s", _name(func), items)
+    with lock:
+        stats["failed"] += len(items)
+    if on_error is None:
+        return
+    for item in items:
+        try:
+            on_error(item, exc)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("on_error failed for %s", item)
+
+
+def _worker(func, inq, outq, stats, lock, on_error):
+    """Apply func to every item from inq and put the result in outq"""
+    while True:
+        item = inq.get()
+        if item is _DONE:
+            # let the sibling workers of this stage see the end as well
+            inq.put(_DONE)
+            break
+        try:
+            res = func(item)
+        except Exception as e:  # pylint: disable=broad-except
+            _failed(func, [item], e, stats, lock, on_error)
+            continue
+        if res is None:
+            with lock:
+                stats["dropped"] += 1
+            continue
+        if outq is not None:
+            outq.put(res)
+        else:
+            with lock:
+                stats["done"] += 1
+
+
+def _get_batch(inq, batch):
+    """Return a list of up to batch items and True if the end is reached"""
+    item = inq.get()
+    if item is _DONE:
+        return [], True
+    items = [item]
+    while len(items) < batch:
+        try:
+            item = inq.get(timeout=BATCH_WAIT)
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def _batch_worker(func, inq, outq, stats, lock, on_error, batch):
+    """Apply func to lists of items from inq and put each result in outq"""
+    done = False
+    while not done:
+        items, done = _get_batch(inq, batch)
+        if done:
+            inq.put(_DONE)
+        if not items:
+            continue
+        try:
+            results = func(items)
+        except Exception as e:  # pylint: disable=broad-except
+            _failed(func, items, e, stats, lock, on_error)
+            continue
+        for res in results:
+            if res is None:
+                with lock:
+                    stats["dropped"] += 1
+            elif outq is not None:
+                outq.put(res)
+            else:
+                with lock:
+                    stats["done"] += 1
+
+
+def _close_stage(threads, outq):
+    """Signal the next stage, when all workers of this stage are done"""
+    for t in threads:
+        t.join()
+    if outq is not None:
+        outq.put(_DONE)
+
+
+def run(source, stages, queue_size=QUEUE_SIZE, on_error=None):
+    """Feed the items from source through the stages.
+
+    stages is a list of (func, workers) or (func, workers, batch). The output of the last stage is
+    discarded. Returns a dict with the number of items read, done (left the last
+    stage), dropped (a stage returned `None`) and failed (a stage raised).
+
+    on_error(item, exception) is called from the worker thread for every item
+    a stage raised on. The item is then dropped.
+    """
+    stats = {"read": 0, "done": 0, "dropped": 0, "failed": 0}
+    lock = threading.Lock()
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    closers = []
+    for n, (func, workers, *batch) in enumerate(stages):
+        inq = queues[n]
+        outq = queues[n + 1] if n + 1 < len(stages) else None
+        if batch:
+            target = _batch_worker
+            args = (func, inq, outq, stats, lock, on_error, batch[0])
+        else:
+            target = _worker
+            args = (func, inq, outq, stats, lock, on_error)
+        threads = [
+            threading.Thread(
+                target=target,
+                args=args,
+                name=f"{_name(func)}-{i}",
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        for t in threads:
+            t.start()
+        closer = threading.Thread(target=_close_stage, args=(threads, outq), daemon=True)
+        closer.start()
+        closers.append(closer)
+
+    # the reader runs in the calling thread. put() blocks when the first
+    # stage is behind
+    try:
+        for item in source:
+            queues[0].put(item)
+            stats["read"] += 1
+    finally:
+        queues[0].put(_DONE)
+        for closer in closers:
+            closer.join()
+
+    LOGGER.info("pipeline finished: %s", stats)
+    return stats
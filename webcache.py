@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""Persistent cache of web-service responses, stored in sqlite.
+
+The cache is keyed by the URL and used by `helpers.wquery`, so all lookups from
+`openlapi` and `googleapi` are cached.
+
+- Entries are fresh for `ttl` seconds. Responses without data, eg. `{}` from
+  openlibrary for an unknown isbn, are fresh for `negative_ttl` seconds.
+- Stale entries with an ETag/Last-Modified are revalidated with a conditional
+  request. A `304 Not Modified` marks the entry fresh again.
+- When the total size of the stored responses exceeds `max_size` bytes, the
+  least recently used entries are removed.
+
+Clear the cache from the command line
+python webcache.py --clear
+"""
+
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DB = "http_cache.sqlite"
+TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+MAX_SIZE = 200 * 1024 * 1024
+
+# fresh: True if the entry can be used without asking the service
+CacheEntry = namedtuple("CacheEntry", "data etag last_modified fresh")
+
+CREATE_SQL = """CREATE TABLE IF NOT EXISTS http_cache (
+        url TEXT NOT NULL,
+        body TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        negative INTEGER,
+        fetched REAL,
+        accessed REAL,
+        size INTEGER,
+        PRIMARY KEY (url)
+);
+CREATE INDEX IF NOT EXISTS http_cache_accessed ON http_cache (accessed);
+"""
+
+
+class WebCache:
+    def __init__(
+        self, db_file=CACHE_DB, ttl=TTL, negative_ttl=NEGATIVE_TTL, max_size=MAX_SIZE
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # the cache is shared by the fetcher threads of the import
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            db_file, check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(CREATE_SQL)
+        self._size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM http_cache"
+        ).fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """Return a CacheEntry for url or None if not cached"""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT body, etag, last_modified, negative, fetched "
+                "FROM http_cache WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            body, etag, last_modified, negative, fetched = row
+            ttl = self.negative_ttl if negative else self.ttl
+            fresh = now - fetched < ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.conn.execute(
+                "UPDATE http_cache SET accessed = ? WHERE url = ?", (now, url)
+            )
+        return CacheEntry(json.loads(body), etag, last_modified, fresh)
+
+    def put(self, url, data, etag=None, last_modified=None):
+        now = time.time()
+        body = json.dumps(data)
+        size = len(body)
+        negative = int(not data)
+        with self._lock:
+            old = self.conn.execute(
+                "SELECT size FROM http_cache WHERE url = ?", (url,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO http_cache "
+                "(url, body, etag, last_modified, negative, fetched, accessed, size) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, body, etag, last_modified, negative, now, now, size),
+            )
+            self._size += size - (old[0] if old else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def refresh(self, url):
+        """Mark url as fresh again, eg. after a `304 Not Modified`"""
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "UPDATE http_cache SET fetched = ?, accessed = ? WHERE url = ?",
+                (now, now, url),
+            )
+
+    def _evict(self):
+        # remove the least recently used entries until we are below max_size.
+        # Must be called with the lock held
+        cur = self.conn.execute("SELECT url, size FROM http_cache ORDER BY accessed")
+        evict = []
+        for url, size in cur:
+            if self._size <= self.max_size:
+                break
+            evict.append((url,))
+            self._size -= size
+        cur.close()
+        LOGGER.debug("evicting %s entries from the web cache", len(evict))
+        self.conn.executemany("DELETE FROM http_cache WHERE url = ?", evict)
+
+    @property
+    def size(self):
+        """Total size in bytes of the cached responses"""
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM http_cache")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=CACHE_DB)
+    parser.add_argument(
+        "--clear", action="store_true", help="remove all cached responses"
+    )
+    args = parser.parse_args()
+
+    cache = WebCache(args.db)
+    if args.clear:
+        cache.clear()
+    print(f"{args.db}: {cache.size} bytes cached")